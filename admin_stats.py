@@ -0,0 +1,98 @@
+# admin_stats.py
+# Dashboard counters for /admin-stats, cached in process.
+#
+# Counts are kept for ADMIN_STATS_TTL seconds and dropped early when a write
+# path reports a change (db.notify_change for "students", "attendance" or
+# "backups"), so polling the dashboard costs nothing on the database between
+# writes. Students come from the in-memory roster and attendance from the
+# daily summary table, so even a recount avoids scanning attendance.
+import os
+import glob
+import time
+import threading
+from datetime import datetime
+from db import get_connection, add_change_listener, Error, ER_NO_SUCH_TABLE
+from roster import roster
+
+ADMIN_STATS_TTL = float(os.getenv("ADMIN_STATS_TTL", "60"))
+BACKUP_DIR = "backups"
+
+
+def _backup_time(path):
+    # backup_YYYYmmdd_HHMMSS.sql, as written by /backup-database; file mtime otherwise
+    try:
+        return datetime.strptime(os.path.basename(path), "backup_%Y%m%d_%H%M%S.sql")
+    except ValueError:
+        return datetime.fromtimestamp(os.path.getmtime(path))
+
+
+def last_backup(folder=BACKUP_DIR):
+    """(file name, 'YYYY-MM-DD HH:MM:SS') of the newest backup, or (None, None)."""
+    newest, newest_time = None, None
+    for path in glob.glob(os.path.join(folder, "backup_*.sql")):
+        try:
+            taken = _backup_time(path)
+        except OSError:
+            continue
+        if newest_time is None or taken > newest_time:
+            newest, newest_time = path, taken
+    if newest is None:
+        return None, None
+    return os.path.basename(newest), newest_time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def count_attendance():
+    conn = get_connection()
+    if conn is None:
+        raise RuntimeError("DB connection failed")
+    cursor = conn.cursor()
+    try:
+        try:
+            cursor.execute("SELECT COALESCE(SUM(present + absent), 0) FROM attendance_daily_summary")
+        except Error as e:
+            if e.errno != ER_NO_SUCH_TABLE:
+                raise
+            cursor.execute("SELECT COUNT(*) FROM attendance")
+        return int(cursor.fetchone()[0])
+    finally:
+        cursor.close()
+        conn.close()
+
+
+class StatsCache:
+    def __init__(self, ttl=ADMIN_STATS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._values = {}
+        self._loaded_at = {}
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, table):
+        with self._lock:
+            self._loaded_at.pop(table, None)
+
+    def _get(self, key, compute):
+        with self._lock:
+            loaded = self._loaded_at.get(key)
+            if loaded is not None and time.time() - loaded <= self.ttl:
+                self.hits += 1
+                return self._values[key]
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._values[key] = value
+            self._loaded_at[key] = time.time()
+        return value
+
+    def snapshot(self):
+        students = self._get("students", lambda: len(roster.get().rows))
+        attendance = self._get("attendance", count_attendance)
+        backup_file, backup_time = self._get("backups", last_backup)
+        return {"totalStudents": students, "attendanceRecords": attendance,
+                "lastBackup": backup_time or "Never", "lastBackupFile": backup_file}
+
+
+stats = StatsCache()
+for _table in ("students", "attendance", "backups"):
+    add_change_listener(_table, stats.invalidate)
@@ -1,20 +1,226 @@
 # attendance_export.py
-import pandas as pd
+# Streaming attendance export (CSV or .xlsx).
+#
+# Rows come off an unbuffered cursor (the server streams the result set, the
+# client reads it) in EXPORT_CHUNK batches and are encoded and handed to the
+# response straight away, so memory stays flat however much history is
+# exported and the header goes out before the query has even run.
+#
+# .xlsx is a zip of XML parts; the sheet is written as inline-string rows
+# into a ZipFile over a non-seekable sink, which makes zipfile use data
+# descriptors and lets every compressed chunk be sent as soon as it exists.
+import os
+import io
+import csv
+import zipfile
+from datetime import date, datetime
+from xml.sax.saxutils import escape
 from db import get_connection
-from io import BytesIO
 
-def export_attendance_to_excel():
-    conn = get_connection()
-    query = """
-    SELECT a.attendance_id, s.name, s.roll_no AS roll, s.branch, s.section, a.date, a.status
-    FROM attendance a
-    JOIN students s ON a.student_id = s.student_id
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK_ROWS", "2000"))
+
+CSV_MIMETYPE = "text/csv"
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# (SQL expression, column header)
+DEFAULT_COLUMNS = [
+    ("a.attendance_id", "attendance_id"),
+    ("s.name", "name"),
+    ("s.roll_no", "roll"),
+    ("s.branch", "branch"),
+    ("s.section", "section"),
+    ("a.date", "date"),
+    ("a.status", "status"),
+]
+
+
+def parse_filters(params):
+    """date_from/date_to (YYYY-MM-DD), branch and section from request args.
+
+    Raises ValueError for a malformed date.
     """
-    df = pd.read_sql(query, conn)
-    output = BytesIO()
-    df.to_excel(output, index=False)
+    filters = {}
+    for key in ("date_from", "date_to"):
+        if params.get(key):
+            filters[key] = datetime.strptime(params[key], "%Y-%m-%d").date()
+    for key in ("branch", "section"):
+        if params.get(key):
+            filters[key] = params[key]
+    return filters
+
+
+def build_query(columns, filters):
+    where, args = [], []
+    if "date_from" in filters:
+        where.append("a.date >= %s")
+        args.append(filters["date_from"])
+    if "date_to" in filters:
+        where.append("a.date <= %s")
+        args.append(filters["date_to"])
+    if "branch" in filters:
+        where.append("s.branch = %s")
+        args.append(filters["branch"])
+    if "section" in filters:
+        where.append("s.section = %s")
+        args.append(filters["section"])
+    sql = "SELECT " + ", ".join(expr for expr, _ in columns) + """
+        FROM attendance a
+        JOIN students s ON a.student_id = s.student_id"""
+    if where:
+        sql += "\n        WHERE " + " AND ".join(where)
+    sql += "\n        ORDER BY a.date DESC, s.section ASC"
+    return sql, args
+
+
+def iter_attendance_chunks(conn, columns=DEFAULT_COLUMNS, filters=None, chunk=EXPORT_CHUNK):
+    """Yield lists of row tuples, at most `chunk` at a time; closes `conn` when done."""
+    sql, args = build_query(columns, filters or {})
+    finished = False
+    cursor = None
+    try:
+        cursor = conn.cursor()  # unbuffered: rows are read from the socket as fetched
+        cursor.execute(sql, args)
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows:
+                break
+            yield rows
+        finished = True
+    finally:
+        if finished:
+            cursor.close()
+            conn.close()
+        else:
+            # abandoned mid-result (client went away): the connection still has
+            # unread rows, so it must not go back to the pool
+            conn.discard()
+
+
+def _cell_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, (date, datetime)):
+        return value.strftime("%Y-%m-%d")
+    return str(value)
+
+
+def stream_csv(conn, columns=DEFAULT_COLUMNS, filters=None, chunk=EXPORT_CHUNK):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([label for _, label in columns])
+    yield ("\ufeff" + buf.getvalue()).encode("utf-8")  # BOM so Excel opens it as UTF-8
+    for rows in iter_attendance_chunks(conn, columns, filters, chunk):
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows([_cell_text(v) for v in row] for row in rows)
+        yield buf.getvalue().encode("utf-8")
+
+
+class _Sink:
+    # Write-only, non-seekable file for ZipFile; the generator drains it
+    def __init__(self):
+        self._parts = []
+        self._pos = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        out = b"".join(self._parts)
+        self._parts = []
+        return out
+
+
+_XLSX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Attendance" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'),
+}
+
+
+def _xlsx_row(values):
+    cells = []
+    for v in values:
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            cells.append(f'<c t="n"><v>{v}</v></c>')
+        else:
+            cells.append(f'<c t="inlineStr"><is><t>{escape(_cell_text(v))}</t></is></c>')
+    return "<row>" + "".join(cells) + "</row>"
+
+
+def stream_xlsx(conn, columns=DEFAULT_COLUMNS, filters=None, chunk=EXPORT_CHUNK):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, xml in _XLSX_PARTS.items():
+            zf.writestr(name, xml)
+        with zf.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                         '<sheetData>' + _xlsx_row([label for _, label in columns])).encode("utf-8"))
+            yield sink.drain()
+            for rows in iter_attendance_chunks(conn, columns, filters, chunk):
+                sheet.write("".join(_xlsx_row(row) for row in rows).encode("utf-8"))
+                yield sink.drain()
+            sheet.write(b"</sheetData></worksheet>")
+    yield sink.drain()
+
+
+def stream_attendance(fmt="xlsx", columns=DEFAULT_COLUMNS, filters=None, chunk=EXPORT_CHUNK):
+    """(generator of bytes, mimetype, file extension) for the requested format.
+
+    The connection is taken up front so an unreachable database is reported
+    (RuntimeError) before any response has started; the query itself only
+    runs once the generator is iterated.
+    """
+    conn = get_connection()
+    if conn is None:
+        raise RuntimeError("DB connection failed")
+    if fmt == "csv":
+        return stream_csv(conn, columns, filters, chunk), CSV_MIMETYPE, "csv"
+    return stream_xlsx(conn, columns, filters, chunk), XLSX_MIMETYPE, "xlsx"
+
+
+def export_attendance_to_excel(filters=None):
+    # Whole workbook in memory; kept for callers that need a file object.
+    # Routes should stream with stream_attendance() instead.
+    body, _, _ = stream_attendance("xlsx", filters=filters)
+    output = io.BytesIO(b"".join(body))
     output.seek(0)
-    conn.close()
     return output
 
 
@@ -1,29 +1,224 @@
 import mysql.connector
 from mysql.connector import Error
 from datetime import datetime
+from dotenv import load_dotenv
+import os
+import time
+import threading
 import json
+import metrics
+from metrics import timed
+
+load_dotenv()
 
 # ==========================
 # DB CONNECTION
 # ==========================
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST", "localhost"),
+    "port": int(os.getenv("DB_PORT", "3306")),
+    "database": os.getenv("DB_NAME", "smartattendance"),
+    "user": os.getenv("DB_USER", "root"),
+    "password": os.getenv("DB_PASSWORD", ""),
+}
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))            # max open connections
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))     # seconds to wait for a free connection
+POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))  # health-check connections idle this long
+POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", "3600"))  # reopen connections older than this
+
+pool_wait_seconds = metrics.histogram("attendance_db_pool_wait_seconds", "Time waited for a pooled connection")
+pool_in_use = metrics.histogram("attendance_db_pool_in_use", "Connections in use after each checkout",
+                                buckets=(1, 2, 3, 5, 8, 10, 15, 20, 30, 50))
+
+
+class PooledConnection:
+    """Wraps a mysql.connector connection; close() hands it back to the pool."""
+
+    def __init__(self, pool, raw, created_at):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+        self._pid = os.getpid()
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            if self._pid != os.getpid():
+                # checked out before a fork: the socket is the parent's
+                self._pool._inherited.append(self._raw)
+                return
+            self._pool._release(self._raw, self._created_at)
+
+    def discard(self):
+        # for a connection left mid-result (e.g. an abandoned streaming read):
+        # drop it instead of returning it to the pool
+        try:
+            self._raw.close()
+        except Exception:
+            pass
+        self.close()
+
+    def __del__(self):
+        # a caller that forgot close() must not leak a pool slot
+        self.close()
+
+
+class ConnectionPool:
+    def __init__(self, config, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.config = config
+        self.size = size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []  # (raw, created_at, returned_at), most recently used last
+        self._inherited = []  # the parent's connections, after a fork
+        self._lock = threading.Lock()
+        self.metrics = {"created": 0, "closed": 0, "checkouts": 0, "timeouts": 0, "failed_checks": 0,
+                        "errors": 0, "in_use": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+    def _after_fork(self):
+        # A forked worker shares the parent's sockets: using one would mix two
+        # processes' packets on one session, and closing one would end the
+        # parent's session too. They are only kept referenced (so no
+        # destructor closes them) and the child opens its own connections.
+        self._inherited.extend(raw for raw, _, _ in self._idle)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self.metrics["in_use"] = 0
+
+    def _connect(self):
+        raw = mysql.connector.connect(**self.config)
+        with self._lock:
+            self.metrics["created"] += 1
+        return raw, time.time()
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self._lock:
+            self.metrics["closed"] += 1
+
+    def _healthy(self, raw, created_at, returned_at):
+        now = time.time()
+        if now - created_at > POOL_RECYCLE:
+            return False
+        if now - returned_at < POOL_PING_AFTER:
+            return True
+        try:
+            raw.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        started = time.time()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.metrics["timeouts"] += 1
+            raise Error(msg=f"connection pool exhausted ({self.size} in use for {self.timeout}s)")
+        waited = time.time() - started
+        try:
+            raw = None
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    raw, created_at = self._connect()
+                    break
+                raw, created_at, returned_at = item
+                if self._healthy(raw, created_at, returned_at):
+                    break
+                with self._lock:
+                    self.metrics["failed_checks"] += 1
+                self._discard(raw)
+        except Exception:
+            self._slots.release()
+            with self._lock:
+                self.metrics["errors"] += 1
+            raise
+        with self._lock:
+            self.metrics["checkouts"] += 1
+            self.metrics["in_use"] += 1
+            self.metrics["wait_seconds_total"] += waited
+            self.metrics["wait_seconds_max"] = max(self.metrics["wait_seconds_max"], waited)
+            in_use = self.metrics["in_use"]
+        pool_wait_seconds.observe(waited)
+        pool_in_use.observe(in_use)
+        return PooledConnection(self, raw, created_at)
+
+    def _release(self, raw, created_at):
+        try:
+            # never hand the next caller an open transaction
+            if raw.is_connected():
+                if raw.in_transaction:
+                    raw.rollback()
+                with self._lock:
+                    self._idle.append((raw, created_at, time.time()))
+            else:
+                self._discard(raw)
+        except Exception:
+            self._discard(raw)
+        finally:
+            with self._lock:
+                self.metrics["in_use"] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.metrics)
+            out["idle"] = len(self._idle)
+        out["size"] = self.size
+        out["wait_seconds_total"] = round(out["wait_seconds_total"], 4)
+        out["wait_seconds_max"] = round(out["wait_seconds_max"], 4)
+        return out
+
+
+_pool = ConnectionPool(DB_CONFIG)
+os.register_at_fork(after_in_child=_pool._after_fork)
+
+
 def get_connection():
     try:
-        conn = mysql.connector.connect(
-            host='localhost',
-            database='smartattendance',
-            user='root',
-            password='vrinda487'
-        )
-        if conn.is_connected():
-            return conn
+        return _pool.acquire()
     except Error as e:
         print(f"Error: {e}")
         return None
 
 
+def pool_stats():
+    return _pool.stats()
+
+
+# ==========================
+# CHANGE NOTIFICATIONS
+# ==========================
+# In-process caches (e.g. the roster) register here and are told when a
+# table they mirror has been written through this module or the API.
+_change_listeners = {}
+
+
+def add_change_listener(table, callback):
+    _change_listeners.setdefault(table, []).append(callback)
+
+
+def notify_change(table):
+    for callback in _change_listeners.get(table, []):
+        try:
+            callback(table)
+        except Exception as e:
+            print(f"Error in {table} change listener: {e}")
+
+
 # ==========================
 # ADMIN FUNCTION: Manage students
 # ==========================
+@timed("db.save_student")
 def save_student(name, roll_no, role="admin", branch=None, section=None, year=None, passout_year=None,photo_path=None):
     if role != "admin":
         print("Unauthorized: only admin can save/update students")
@@ -36,7 +231,7 @@ def save_student(name, roll_no, role="admin", branch=None, section=None, year=No
         cursor = conn.cursor(dictionary=True)
 
         # Check if student exists
-        cursor.execute(" SELECT student_id FROM students WHERE roll_no = %s", (roll_no,))
+        cursor.execute(" SELECT student_id, section FROM students WHERE roll_no = %s", (roll_no,))
         result = cursor.fetchone()
 
         if result:
@@ -46,6 +241,9 @@ def save_student(name, roll_no, role="admin", branch=None, section=None, year=No
                    WHERE student_id=%s""",
                 (name, branch, section, year, passout_year,photo_path, student_id)
             )
+            if (result['section'] or "") != (section or ""):
+                # the student's past attendance now counts for the new section
+                refresh_daily_summary(cursor, sections=[result['section'], section])
         else:
             cursor.execute(
                 """INSERT INTO students (name, roll_no, branch, section, year, passout_year,photo_path)
@@ -55,6 +253,7 @@ def save_student(name, roll_no, role="admin", branch=None, section=None, year=No
             student_id = cursor.lastrowid
 
         conn.commit()
+        notify_change("students")
         return student_id
     finally:
         if conn:
@@ -66,27 +265,164 @@ def save_student(name, roll_no, role="admin", branch=None, section=None, year=No
 # ==========================
 # TEACHER FUNCTION: Save attendance
 # ==========================
+ATTENDANCE_CHUNK = 1000  # rows per INSERT statement
+
+
 def save_attendance(student_id, recorded_by, recognized=True, role="teacher"):
+    return save_attendance_bulk([(student_id, recognized)], recorded_by, role=role)
+
+
+@timed("db.save_attendance_bulk")
+def save_attendance_bulk(records, recorded_by, date=None, role="teacher", keep_present=False):
+    """Record a whole class in one transaction.
+
+    `records` is an iterable of (student_id, recognized) pairs or a
+    {student_id: recognized} dict. Rows are upserted on the
+    (student_id, date) unique key (migrations/0001), so retrying the same
+    call is safe; the last write for a student/date wins, except that with
+    `keep_present` an existing Present row is never turned into Absent (a
+    later roll call that missed someone must not undo an earlier sighting).
+    Returns the number of students written, or None on failure.
+    """
     if role != "teacher":
         print("Unauthorized: only teacher can save attendance")
-        return
+        return None
+
+    if isinstance(records, dict):
+        records = records.items()
+    day = date or datetime.now().strftime("%Y-%m-%d")
+    # de-duplicate in Python too: one statement can't upsert the same key twice predictably
+    statuses = {}
+    for student_id, recognized in records:
+        statuses[student_id] = "Present" if recognized else "Absent"
+    if not statuses:
+        return 0
 
+    rows = [(student_id, day, status, recorded_by) for student_id, status in statuses.items()]
+    if keep_present:
+        # recorded_by first: assignments see the row as already updated by earlier ones
+        update = """recorded_by = IF(attendance.status = 'Present', attendance.recorded_by, new.recorded_by),
+                    status = IF(attendance.status = 'Present', attendance.status, new.status)"""
+    else:
+        update = "status = new.status, recorded_by = new.recorded_by"
     conn = get_connection()
     if conn is None:
-        return
+        return None
+    cursor = None
     try:
         cursor = conn.cursor()
-        date_today = datetime.now().strftime("%Y-%m-%d")
-        status = "Present" if recognized else "Absent"
+        for i in range(0, len(rows), ATTENDANCE_CHUNK):
+            chunk = rows[i:i + ATTENDANCE_CHUNK]
+            placeholders = ", ".join(["(%s, %s, %s, %s)"] * len(chunk))
+            cursor.execute(
+                f"""INSERT INTO attendance (student_id, date, status, recorded_by)
+                    VALUES {placeholders} AS new
+                    ON DUPLICATE KEY UPDATE {update}""",
+                [value for row in chunk for value in row]
+            )
+        ids = list(statuses)
         cursor.execute(
-            "INSERT INTO attendance (student_id, date, status, recorded_by) VALUES (%s, %s, %s, %s)",
-            (student_id, date_today, status, recorded_by)
+            f"SELECT DISTINCT section FROM students WHERE student_id IN ({', '.join(['%s'] * len(ids))})", ids
         )
+        refresh_daily_summary(cursor, sections=[row[0] for row in cursor.fetchall()], date=day)
         conn.commit()
+        notify_change("attendance")
+        return len(rows)
+    except Error as e:
+        conn.rollback()
+        print(f"Error saving attendance: {e}")
+        return None
     finally:
-        if conn:
+        if cursor is not None:
             cursor.close()
-            conn.close()
+        conn.close()
+
+
+
+
+
+
+
+
+# ==========================
+# DAILY SUMMARY
+# ==========================
+# attendance_daily_summary (migrations/0002) holds present/absent counts per
+# section per day. Writes that change attendance or a student's section
+# recount the affected (section, date) rows in the same transaction, so
+# /attendance-report never has to aggregate the attendance table itself.
+ER_NO_SUCH_TABLE = 1146
+
+
+@timed("db.refresh_daily_summary")
+def refresh_daily_summary(cursor, sections=None, date=None):
+    """Recount summary rows from attendance on the caller's cursor.
+
+    `sections` limits the recount to those sections (None as a section
+    means students without one); `sections=None` recounts all of them.
+    `date` limits it to one day. The caller commits. A database without
+    the summary table is skipped with a warning rather than failing the write.
+    """
+    summary_where, source_where, summary_args, source_args = [], [], [], []
+    if sections is not None:
+        keys = sorted({s or "" for s in sections})
+        if not keys:
+            return
+        summary_where.append(f"section IN ({', '.join(['%s'] * len(keys))})")
+        summary_args.extend(keys)
+        # spelled out rather than COALESCE() so idx_students_section (0003) can be used
+        named = [k for k in keys if k]
+        conditions = [f"s.section IN ({', '.join(['%s'] * len(named))})"] if named else []
+        if "" in keys:
+            conditions.append("s.section IS NULL OR s.section = ''")
+        source_where.append("(" + " OR ".join(conditions) + ")")
+        source_args.extend(named)
+    if date is not None:
+        summary_where.append("date = %s")
+        source_where.append("a.date = %s")
+        summary_args.append(date)
+        source_args.append(date)
+    summary_clause = (" WHERE " + " AND ".join(summary_where)) if summary_where else ""
+    source_clause = ("\n               WHERE " + " AND ".join(source_where)) if source_where else ""
+    try:
+        cursor.execute("DELETE FROM attendance_daily_summary" + summary_clause, summary_args)
+        cursor.execute(
+            """INSERT INTO attendance_daily_summary (section, date, present, absent)
+               SELECT COALESCE(s.section, ''), a.date,
+                      SUM(a.status = 'Present'), SUM(a.status = 'Absent')
+               FROM attendance a
+               JOIN students s ON a.student_id = s.student_id""" + source_clause + """
+               GROUP BY COALESCE(s.section, ''), a.date""",
+            source_args
+        )
+    except Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            raise
+        print("Warning: attendance_daily_summary missing; apply migrations/0002")
+
+
+def rebuild_daily_summary():
+    """Recount the whole summary table; returns the number of summary rows."""
+    conn = get_connection()
+    if conn is None:
+        return None
+    cursor = conn.cursor()
+    try:
+        refresh_daily_summary(cursor)
+        conn.commit()
+        cursor.execute("SELECT COUNT(*) FROM attendance_daily_summary")
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["rebuild-summary"]:
+        print(f"[DONE] attendance_daily_summary rebuilt: {rebuild_daily_summary()} rows")
+    else:
+        print("usage: python db.py rebuild-summary")
 
 
 
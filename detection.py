@@ -0,0 +1,217 @@
+# detection.py
+# Face detection on a downscaled copy of the photo.
+#
+# HOG cost grows with pixel count, so a 12-48 MP phone photo is shrunk to
+# FACE_DETECT_WIDTH before face_locations runs. The scale never drops so
+# low that a FACE_MIN_SIZE face falls under what HOG can see (~40 px with
+# one upsample). Boxes are mapped back to the original image so that
+# face_encodings still works on full-resolution pixels.
+#
+# FACE_MIN_SIZE only sizes the fast pass; the floor that counts is the
+# smallest face actually in the photo. Face sizes in a classroom shrink
+# gradually towards the back of the room, i.e. the top of the photo, so
+# when the fast pass finds faces close to its floor smaller ones are likely
+# above them: that band (down to just below the lowest such face) is
+# detected again at full size, where HOG sees down to ~40 px, and the rows
+# below keep their fast-pass faces. A photo with no faces found is redone
+# whole; one of only large faces keeps the fast result. Small faces below
+# every near-floor face, or a jump from well above the floor straight to
+# below it, can still be lost; FACE_MIN_SIZE=40 turns the fast pass off.
+#
+# Very large photos can also be cut into overlapping tiles that are detected
+# and encoded on a process pool, then de-duplicated at the tile borders.
+import os
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import face_recognition
+from metrics import span
+
+DETECT_WIDTH = int(os.getenv("FACE_DETECT_WIDTH", "1600"))  # 0 = always detect at full size
+MIN_FACE_SIZE = int(os.getenv("FACE_MIN_SIZE", "80"))       # floor (px, original image) of the fast pass
+HOG_MIN_FACE = 40  # dlib's 80px HOG window with number_of_times_to_upsample=1
+FLOOR_MARGIN = 1.5  # a face within this factor of the fast-pass floor triggers the full-size pass
+
+# Tiled mode: large photos are cut into overlapping tiles detected in parallel
+TILING = os.getenv("FACE_TILING", "auto").lower()                # auto | on | off
+TILE_SIZE = int(os.getenv("FACE_TILE_SIZE", "1024"))             # tile edge at detection scale
+TILE_OVERLAP = int(os.getenv("FACE_TILE_OVERLAP", "160"))        # >= largest expected face, original px
+TILE_MIN_PIXELS = int(os.getenv("FACE_TILE_MIN_PIXELS", str(12_000_000)))
+TILE_WORKERS = int(os.getenv("FACE_TILE_WORKERS", os.cpu_count() or 1))
+NMS_IOU = 0.3
+
+
+def detection_scale(width, detect_width=DETECT_WIDTH, min_face=MIN_FACE_SIZE):
+    if not detect_width or width <= detect_width:
+        return 1.0
+    scale = detect_width / float(width)
+    # keep the smallest wanted face detectable after shrinking
+    if min_face and min_face * scale < HOG_MIN_FACE:
+        scale = HOG_MIN_FACE / float(min_face)
+    return min(scale, 1.0)
+
+
+def retry_band(boxes, scale):
+    """Bottom row of the band [0, bottom) to detect again at full size, or
+    None when no face found at `scale` is within FLOOR_MARGIN of the HOG floor.
+
+    The band ends one face height below the lowest near-floor face and is
+    pushed down past any face it would cut through, so every fast-pass box
+    lies wholly inside or wholly below it.
+    """
+    near = [b for b in boxes if min(b[2] - b[0], b[1] - b[3]) * scale < HOG_MIN_FACE * FLOOR_MARGIN]
+    if not near:
+        return None
+    lowest = max(near, key=lambda b: b[2])
+    bottom = lowest[2] + (lowest[2] - lowest[0])
+    for top, _, box_bottom, _ in sorted(boxes):
+        if top < bottom < box_bottom:
+            bottom = box_bottom
+    return bottom
+
+
+def detect_faces(image, model="hog", detect_width=DETECT_WIDTH, min_face=MIN_FACE_SIZE, scale=None,
+                 retry_empty=True):
+    """face_locations() on a downscaled copy; boxes are in original-image coordinates.
+
+    Where the downscaled pass finds faces near its floor, that band of the
+    photo is detected again at full size; a pass that found nothing is redone
+    whole unless `retry_empty` is off (see the header).
+    """
+    height, width = image.shape[:2]
+    if scale is None:
+        scale = detection_scale(width, detect_width, min_face)
+    if scale >= 1.0:
+        return face_recognition.face_locations(image, model=model)
+    small = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    boxes = [scale_box(box, 1.0 / scale, width, height)
+             for box in face_recognition.face_locations(small, model=model)]
+    if not boxes:
+        return face_recognition.face_locations(image, model=model) if retry_empty else boxes
+    bottom = retry_band(boxes, scale)
+    if bottom is None:
+        return boxes
+    if bottom >= height:
+        return face_recognition.face_locations(image, model=model)
+    # row slices of a C-contiguous image are contiguous, so no copy
+    return (face_recognition.face_locations(image[:bottom], model=model)
+            + [b for b in boxes if b[0] >= bottom])
+
+
+def scale_box(box, factor, width, height):
+    top, right, bottom, left = box
+    return (max(0, int(round(top * factor))), min(width, int(round(right * factor))),
+            min(height, int(round(bottom * factor))), max(0, int(round(left * factor))))
+
+
+def detect_and_encode(image, model="hog", **kwargs):
+    # Landmarks and encodings always come from the full-resolution image
+    with span("detect"):
+        boxes = detect_faces(image, model=model, **kwargs)
+    with span("encode"):
+        return boxes, face_recognition.face_encodings(image, boxes)
+
+
+# ==========================
+# Tiled detection
+# ==========================
+def tile_grid(width, height, tile, overlap):
+    """(x0, y0, x1, y1) windows of at most tile x tile covering the image with `overlap` px shared."""
+    step = max(1, tile - overlap)
+    xs = list(range(0, max(1, width - overlap), step))
+    ys = list(range(0, max(1, height - overlap), step))
+    return [(x, y, min(width, x + tile), min(height, y + tile)) for y in ys for x in xs]
+
+
+def _detect_tile(tile_image, x0, y0, scale, model):
+    # empty tiles (walls, ceiling) are common, so only faces near the floor send a tile to full size
+    boxes = detect_faces(tile_image, model=model, scale=scale, retry_empty=False)
+    encodings = face_recognition.face_encodings(tile_image, boxes)
+    shifted = [(t + y0, r + x0, b + y0, l + x0) for t, r, b, l in boxes]
+    return shifted, [np.asarray(e, dtype=np.float32) for e in encodings]
+
+
+def box_iou(a, b):
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    inter = max(0, bottom - top) * max(0, right - left)
+    area = lambda x: (x[2] - x[0]) * (x[1] - x[3])
+    union = area(a) + area(b) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def suppress_duplicates(boxes, encodings, iou=NMS_IOU):
+    """Non-maximum suppression for faces found twice in overlapping tiles.
+
+    HOG gives no score, so the larger box wins: it is the copy that was
+    not clipped by a tile border.
+    """
+    order = sorted(range(len(boxes)), key=lambda i: -(boxes[i][2] - boxes[i][0]) * (boxes[i][1] - boxes[i][3]))
+    kept = []
+    for i in order:
+        if all(box_iou(boxes[i], boxes[j]) <= iou for j in kept):
+            kept.append(i)
+    kept.sort(key=lambda i: (boxes[i][0], boxes[i][3]))
+    return [boxes[i] for i in kept], [encodings[i] for i in kept]
+
+
+_tile_pool = None
+
+
+def _reset_after_fork():
+    # An executor inherited over fork keeps the parent's manager-thread
+    # handle, so submits in the child would never run; start a new one
+    global _tile_pool
+    _tile_pool = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def limit_tile_workers(workers):
+    """Cap this process's tile pool, e.g. in recognition workers that already
+    run one per core share; call before the first tiled detection."""
+    global TILE_WORKERS
+    TILE_WORKERS = max(1, min(TILE_WORKERS, workers))
+
+
+def _get_tile_pool():
+    global _tile_pool
+    if _tile_pool is None:
+        _tile_pool = ProcessPoolExecutor(max_workers=TILE_WORKERS)
+        atexit.register(_tile_pool.shutdown, wait=False)
+    return _tile_pool
+
+
+def use_tiling(image, tiled=None):
+    if tiled is not None:
+        return bool(tiled)
+    if TILING == "on":
+        return True
+    if TILING == "off" or TILE_WORKERS <= 1:
+        return False
+    return image.shape[0] * image.shape[1] >= TILE_MIN_PIXELS
+
+
+def detect_and_encode_tiled(image, model="hog", detect_width=DETECT_WIDTH, min_face=MIN_FACE_SIZE):
+    """Same output as detect_and_encode(), with tiles spread over a process pool."""
+    height, width = image.shape[:2]
+    # detection scale of the whole photo, so every tile shrinks to ~TILE_SIZE
+    scale = detection_scale(width, detect_width, min_face)
+    tile = max(TILE_OVERLAP + 1, int(TILE_SIZE / scale))
+    windows = tile_grid(width, height, tile, TILE_OVERLAP)
+    if len(windows) == 1:
+        return detect_and_encode(image, model=model, detect_width=detect_width, min_face=min_face)
+
+    pool = _get_tile_pool()
+    with span("detect_encode_tiled"):
+        futures = [pool.submit(_detect_tile, np.ascontiguousarray(image[y0:y1, x0:x1]), x0, y0, scale, model)
+                   for x0, y0, x1, y1 in windows]
+        boxes, encodings = [], []
+        for future in futures:
+            b, e = future.result()
+            boxes.extend(b)
+            encodings.extend(e)
+    with span("tile_nms"):
+        return suppress_duplicates(boxes, encodings)
@@ -1,40 +1,39 @@
 import os
-import cv2
-import face_recognition
-import pickle
+import sys
+import encodings_store
+import encoding_builder
 
 # Path where student images are stored
 STUDENT_IMAGES_DIR = "student_images/"
-ENCODINGS_FILE = "encodings.pickle"
-
-known_encodings = []
-known_names = []
-
-print("[INFO] Processing student images...")
-
-# Loop through each image in student_images/
-for filename in os.listdir(STUDENT_IMAGES_DIR):
-    if filename.endswith((".jpg", ".png", ".jpeg")):
-        name = os.path.splitext(filename)[0]  # Student name = file name
-        filepath = os.path.join(STUDENT_IMAGES_DIR, filename)
-
-        # Load image
-        image = cv2.imread(filepath)
-        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-        # Detect face and compute encodings
-        boxes = face_recognition.face_locations(rgb, model="hog")  # or "cnn" for more accuracy
-        encodings = face_recognition.face_encodings(rgb, boxes)
-
-        for encoding in encodings:
-            known_encodings.append(encoding)
-            known_names.append(name)
-
-        print(f"[OK] Processed {filename} -> {name}")
-
-# Save encodings to file
-data = {"encodings": known_encodings, "names": known_names}
-with open(ENCODINGS_FILE, "wb") as f:
-    pickle.dump(data, f)
-
-print(f"[DONE] Encodings saved to {ENCODINGS_FILE}")
+ENCODINGS_FILE = encodings_store.STORE_PATH
+
+
+def collect_photos(folder=STUDENT_IMAGES_DIR):
+    photos = []
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith((".jpg", ".png", ".jpeg")):
+            name = os.path.splitext(filename)[0]  # Student name = file name
+            photos.append({"path": os.path.join(folder, filename), "name": name, "id": None})
+    return photos
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    full = "--full" in args
+    workers = int(args[args.index("--workers") + 1]) if "--workers" in args else None
+
+    print("[INFO] Processing student images...")
+    photos = collect_photos()
+
+    # Only new/changed photos are encoded; unchanged rows are reused
+    report = encoding_builder.rebuild(photos, path=ENCODINGS_FILE, full=full, workers=workers)
+
+    print(f"[INFO] added={report['added']} changed={report['changed']} removed={report['removed']} "
+          f"unchanged={report['unchanged']} failed={len(report['failed'])} in {report['seconds']}s "
+          f"({report['photos_per_sec'] or 0} photos/sec)")
+    if report["written"]:
+        print(f"[DONE] {report['rows']} encodings saved to {encodings_store.matrix_path(ENCODINGS_FILE, report['version'])} "
+              f"(v{report['version']})")
+        print(f"[DONE] Search index: {report['index']}")
+    else:
+        print("[DONE] Encodings already up to date")
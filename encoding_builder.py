@@ -0,0 +1,315 @@
+# encoding_builder.py
+# Incremental builder for the encodings store.
+#
+# A manifest (encodings.manifest.json) remembers, for every photo path, the
+# size/mtime it had and the sha1 of its contents. The store sidecar records
+# the content hash each row was encoded from. A rebuild therefore only
+# decodes and encodes photos whose content it has never seen; rows for
+# unchanged photos are copied over from the existing store and rows for
+# removed photos are dropped.
+#
+# Rows enrolled without a photo (ENROLLED_PREFIX) are carried over by every
+# rebuild, full ones included, since there is nothing to re-encode them
+# from. Rebuilds and enrolments hold the store lock for their whole
+# load -> modify -> write, so neither can overwrite the other's rows.
+import os
+import json
+import time
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import face_recognition
+import encodings_store
+import face_index
+import detection
+import metrics
+from metrics import span
+
+MANIFEST_VERSION = 1
+ENROLLED_PREFIX = "enrolled:"  # rows added without a photo (e.g. from an unknown-face cluster)
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", os.cpu_count() or 1))
+ENCODE_INFLIGHT_PER_WORKER = 2
+STORE_LOCK_TIMEOUT = float(os.getenv("STORE_LOCK_TIMEOUT", "300"))  # wait this long for another build
+STORE_LOCK_STALE = 3600  # a build lock older than this was left by a dead process
+
+
+def store_lock(path=encodings_store.STORE_PATH):
+    return encodings_store.FileLock(path, timeout=STORE_LOCK_TIMEOUT, stale=STORE_LOCK_STALE)
+
+
+def manifest_path(path=encodings_store.STORE_PATH):
+    return path + ".manifest.json"
+
+
+def load_manifest(path=encodings_store.STORE_PATH):
+    try:
+        with open(manifest_path(path), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {"version": MANIFEST_VERSION, "photos": {}}
+
+
+def save_manifest(manifest, path=encodings_store.STORE_PATH):
+    tmp = f"{manifest_path(path)}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, manifest_path(path))
+
+
+def file_sha1(filepath, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def encode_photo(filepath, first_only=False, model="hog"):
+    image = face_recognition.load_image_file(filepath)
+    boxes, encodings = detection.detect_and_encode(image, model=model)
+    if first_only:
+        encodings = encodings[:1]
+    return [np.asarray(e, dtype=np.float32) for e in encodings]
+
+
+def _encode_task(filepath, first_only):
+    # Runs in a pool worker; errors come back as strings so one bad photo
+    # doesn't take the whole build down
+    try:
+        return filepath, encode_photo(filepath, first_only=first_only), None
+    except Exception as e:
+        return filepath, None, f"{type(e).__name__}: {e}"
+
+
+def encode_many(paths, first_only=False, workers=None):
+    """Yield (path, encodings, error) for every path, in completion order.
+
+    Photos are fanned out over a process pool with at most
+    workers * ENCODE_INFLIGHT_PER_WORKER submitted at once, so memory stays
+    bounded however many photos are queued.
+
+    A photo that kills its worker outright (a dlib segfault on a corrupt or
+    huge image) breaks the whole pool. The photos that were in flight are
+    then encoded one at a time, each on a pool of its own, so the culprit
+    comes back as a failure and the rest of the build carries on.
+    """
+    # never more processes than the configured pool size, whatever was asked for
+    workers = max(1, min(workers or ENCODE_WORKERS, ENCODE_WORKERS or os.cpu_count() or 1))
+    if workers <= 1 or len(paths) <= 1:
+        for filepath in paths:
+            yield _encode_task(filepath, first_only)
+        return
+
+    todo = iter(paths)
+    while True:
+        crashed = yield from _encode_pooled(todo, first_only, min(workers, len(paths)))
+        if not crashed:
+            return
+        for filepath in crashed:
+            yield _encode_alone(filepath, first_only)
+
+
+def _encode_pooled(todo, first_only, workers):
+    # Yields results until `todo` is used up; returns the paths whose
+    # results were lost if the pool broke, with the rest of `todo` unread
+    limit = workers * ENCODE_INFLIGHT_PER_WORKER
+    crashed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = {pool.submit(_encode_task, filepath, first_only): filepath
+                     for filepath in itertools.islice(todo, limit)}
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                filepath = in_flight.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    crashed.append(filepath)
+            if not crashed:
+                for filepath in itertools.islice(todo, len(done)):
+                    in_flight[pool.submit(_encode_task, filepath, first_only)] = filepath
+    return crashed
+
+
+def _encode_alone(filepath, first_only):
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        try:
+            return pool.submit(_encode_task, filepath, first_only).result()
+        except BrokenProcessPool:
+            return filepath, None, "BrokenProcessPool: encoding worker died on this photo"
+
+
+def _photo_hash(photo, old_entry):
+    # Reuse the recorded hash while size and mtime are unchanged
+    st = os.stat(photo["path"])
+    if old_entry and old_entry.get("size") == st.st_size and old_entry.get("mtime_ns") == st.st_mtime_ns:
+        return old_entry["sha1"], st
+    return file_sha1(photo["path"]), st
+
+
+def rebuild(photos, path=encodings_store.STORE_PATH, first_only=False, full=False, workers=None, log=print,
+            student_ids=None):
+    """Bring the store in line with `photos` ([{"path", "name", "id"}, ...]).
+
+    Enrolled rows are kept, except those whose id is not in `student_ids`
+    when that set of existing students is given.
+
+    Returns a report dict with added/changed/removed/unchanged/failed counts
+    and the encoding throughput (photos_per_sec).
+    """
+    with store_lock(path):
+        return _rebuild(photos, path, first_only, full, workers, log, student_ids)
+
+
+def _rebuild(photos, path, first_only, full, workers, log, student_ids):
+    started = time.time()
+    manifest = {"version": MANIFEST_VERSION, "photos": {}} if full else load_manifest(path)
+    old_photos = manifest["photos"]
+
+    # rows of the current store, grouped by the content hash they came from
+    old_matrix, old_rows, old_meta = None, {}, None
+    if encodings_store.exists(path):
+        try:
+            old_matrix, meta = encodings_store.load_store(path)
+            old_meta = meta
+            for i, h in enumerate(meta.get("hashes", [])):
+                old_rows.setdefault(h, []).append(i)
+        except encodings_store.StoreError as e:
+            log(f"[WARN] Existing store ignored, rebuilding from scratch: {e}")
+            old_photos = {}
+    enrolled = {h: rows for h, rows in old_rows.items() if h.startswith(ENROLLED_PREFIX)}
+    if full:
+        old_rows = {}  # every photo is encoded again; enrolled rows still carry over below
+
+    report = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0, "failed": [], "enrolled_dropped": 0}
+    new_manifest = {"version": MANIFEST_VERSION, "photos": {}}
+    blocks, names, ids, hashes = [], [], [], []
+    seen = set()
+
+    # Pass 1: hash every photo and reuse whatever the store already has
+    hash_started = time.time()
+    plan, pending = [], []
+    for photo in photos:
+        filepath = photo["path"]
+        if filepath in seen:
+            continue
+        seen.add(filepath)
+        old_entry = old_photos.get(filepath)
+        try:
+            sha1, st = _photo_hash(photo, old_entry)
+        except OSError as e:
+            report["failed"].append({"path": filepath, "error": str(e)})
+            continue
+
+        if sha1 in old_rows:
+            vectors = np.asarray(old_matrix[old_rows[sha1]], dtype=np.float32)
+            report["unchanged"] += 1
+        elif old_entry and old_entry.get("sha1") == sha1 and old_entry.get("faces") == 0:
+            vectors = np.zeros((0, encodings_store.ENCODING_DIM), dtype=np.float32)
+            report["unchanged"] += 1
+        else:
+            vectors = None
+            pending.append(filepath)
+        plan.append((photo, sha1, st, old_entry, vectors))
+
+    metrics.record("build.hash", time.time() - hash_started)
+
+    # Pass 2: encode the rest on the process pool, collecting results as they finish
+    encoded = {}
+    encode_started = time.time()
+    for filepath, found, error in encode_many(pending, first_only=first_only, workers=workers):
+        if error is not None:
+            report["failed"].append({"path": filepath, "error": error})
+            log(f"[FAIL] {filepath}: {error}")
+            continue
+        encoded[filepath] = np.asarray(found, dtype=np.float32).reshape(-1, encodings_store.ENCODING_DIM)
+        log(f"[OK] Encoded {filepath} ({len(encoded[filepath])} face(s))")
+    encode_seconds = time.time() - encode_started
+    metrics.record("build.encode", encode_seconds)
+    report["encoded"] = len(encoded)
+    report["photos_per_sec"] = round(len(pending) / encode_seconds, 2) if pending and encode_seconds > 0 else None
+
+    for photo, sha1, st, old_entry, vectors in plan:
+        filepath = photo["path"]
+        if vectors is None:
+            if filepath not in encoded:
+                continue
+            vectors = encoded[filepath]
+            report["changed" if old_entry else "added"] += 1
+
+        blocks.append(vectors)
+        names.extend([photo.get("name")] * len(vectors))
+        ids.extend([photo.get("id")] * len(vectors))
+        hashes.extend([sha1] * len(vectors))
+        new_manifest["photos"][filepath] = {
+            "sha1": sha1, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+            "name": photo.get("name"), "id": photo.get("id"), "faces": len(vectors),
+        }
+
+    # rows enrolled without a photo have no manifest entry; carry them over
+    # unless their student has been deleted
+    for h, rows in enrolled.items():
+        if student_ids is not None:
+            kept = [i for i in rows if old_meta["ids"][i] in student_ids]
+            report["enrolled_dropped"] += len(rows) - len(kept)
+            rows = kept
+        if not rows:
+            continue
+        blocks.append(np.asarray(old_matrix[rows], dtype=np.float32))
+        names.extend(old_meta["names"][i] for i in rows)
+        ids.extend(old_meta["ids"][i] for i in rows)
+        hashes.extend([h] * len(rows))
+
+    report["removed"] = len(set(old_photos) - seen)
+    dirty = full or report["added"] or report["changed"] or report["removed"] or report["enrolled_dropped"] \
+        or not encodings_store.exists(path) or _labels_changed(old_photos, new_manifest["photos"])
+
+    if dirty:
+        matrix = np.concatenate(blocks) if blocks else np.zeros((0, encodings_store.ENCODING_DIM), np.float32)
+        with span("build.write"):
+            meta = encodings_store.write_store(matrix, names, ids, path=path, extra={"hashes": hashes})
+        with span("build.index"):
+            report["index"] = face_index.build_index(path)
+        report["version"] = meta["version"]
+    save_manifest(new_manifest, path)
+
+    report["rows"] = len(names)
+    report["written"] = bool(dirty)
+    report["seconds"] = round(time.time() - started, 3)
+    return report
+
+
+def _labels_changed(old_photos, new_photos):
+    return any((old_photos.get(p) or {}).get("name") != e["name"] or (old_photos.get(p) or {}).get("id") != e["id"]
+               for p, e in new_photos.items())
+
+
+def enroll_encodings(vectors, name, student_id, source, path=encodings_store.STORE_PATH):
+    """Append encodings that have no source photo (e.g. an unknown-face cluster).
+
+    They are tagged with an ENROLLED_PREFIX hash so rebuilds keep them.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, encodings_store.ENCODING_DIM)
+    with store_lock(path):
+        return _enroll(vectors, name, student_id, source, path)
+
+
+def _enroll(vectors, name, student_id, source, path):
+    if encodings_store.exists(path):
+        matrix, meta = encodings_store.load_store(path)
+        names, ids = list(meta["names"]), list(meta["ids"])
+        hashes = list(meta.get("hashes", [None] * len(names)))
+    else:
+        matrix, names, ids, hashes = np.zeros((0, encodings_store.ENCODING_DIM), np.float32), [], [], []
+    tag = f"{ENROLLED_PREFIX}{source}"
+    meta = encodings_store.write_store(
+        np.concatenate([np.asarray(matrix, dtype=np.float32), vectors]),
+        names + [name] * len(vectors), ids + [student_id] * len(vectors),
+        path=path, extra={"hashes": hashes + [tag] * len(vectors)})
+    meta["index"] = face_index.build_index(path)
+    return meta
@@ -0,0 +1,232 @@
+# encodings_store.py
+# Binary, memory-mappable store for the known face encodings.
+#
+#   encodings.v<N>.f32  64-byte header + contiguous float32 matrix (rows x dim)
+#   encodings.json      sidecar: format, build version, matrix file name,
+#                       shape, crc32, names, ids
+#
+# Every build writes a new matrix file, named after its version, and only
+# then os.replace()s the sidecar that points at it. A matrix file is never
+# replaced while a server process has it memory-mapped (Windows refuses
+# that), and a reader always finds the matrix its sidecar names. Versions
+# older than the previous one are deleted by the next write; one still
+# mapped somewhere (Windows again) is left for a later write. The checksum
+# in the sidecar still turns a truncated or foreign file into a StoreError.
+import os
+import sys
+import glob
+import json
+import time
+import zlib
+import struct
+import numpy as np
+
+STORE_PATH = "encodings"  # -> encodings.f32 + encodings.json
+FORMAT_VERSION = 1
+ENCODING_DIM = 128
+
+_MAGIC = b"SAENC\x00\x00\x00"
+_HEADER = struct.Struct("<8sIII")  # magic, format, rows, dim
+_HEADER_SIZE = 64  # data starts on a cache-line boundary
+
+
+class StoreError(Exception):
+    pass
+
+
+class FileLock:
+    """O_EXCL lock file next to `path`: works the same on Linux and Windows.
+
+    A lock file older than `stale` seconds is assumed to belong to a process
+    that died and is taken over.
+    """
+
+    def __init__(self, path, timeout=10.0, stale=30.0):
+        self.path = path + ".lock"
+        self.timeout = timeout
+        self.stale = stale
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.stale:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                if time.time() > deadline:
+                    raise TimeoutError(f"could not lock {self.path}")
+                time.sleep(0.02)
+
+    def __exit__(self, *exc):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def matrix_path(path=STORE_PATH, version=None):
+    """Matrix file of build `version`; without one, the unversioned name
+    stores written before versioned files used."""
+    return path + ".f32" if version is None else f"{path}.v{int(version)}.f32"
+
+
+def sidecar_path(path=STORE_PATH):
+    return path + ".json"
+
+
+def exists(path=STORE_PATH):
+    # a missing matrix is reported by load_store(), like any other bad store
+    return os.path.exists(sidecar_path(path))
+
+
+def _matrix_file(path, meta):
+    if "matrix" not in meta:
+        return matrix_path(path)
+    return os.path.join(os.path.dirname(path), meta["matrix"])
+
+
+def _remove_old_matrices(path, version):
+    # keeps `version` and the one before it, which a reader may have just
+    # found in the previous sidecar and not opened yet
+    keep = {os.path.normcase(matrix_path(path, v)) for v in (version, version - 1)}
+    for fname in glob.glob(glob.escape(path) + ".v*.f32") + [matrix_path(path)]:
+        if os.path.normcase(fname) in keep:
+            continue
+        try:
+            os.remove(fname)
+        except OSError:
+            pass  # missing, or still mapped by a process on Windows
+
+
+def _replace_atomic(target, write):
+    tmp = f"{target}.tmp{os.getpid()}"
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def read_sidecar(path=STORE_PATH):
+    try:
+        with open(sidecar_path(path), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError) as e:
+        raise StoreError(f"unreadable sidecar {sidecar_path(path)}: {e}")
+    if meta.get("format") != FORMAT_VERSION:
+        raise StoreError(f"unsupported store format {meta.get('format')!r}")
+    return meta
+
+
+def write_store(encodings, names, ids=None, path=STORE_PATH, extra=None):
+    """Write a new store and return its sidecar dict.
+
+    `ids` are student_ids (or None when a row only has a name). `extra` is
+    merged into the sidecar for callers that need to keep more per-store data.
+    """
+    matrix = np.ascontiguousarray(np.asarray(encodings, dtype="<f4"))
+    if matrix.size == 0:
+        matrix = matrix.reshape(0, ENCODING_DIM)
+    if matrix.ndim != 2:
+        raise StoreError(f"expected a 2-D encodings matrix, got shape {matrix.shape}")
+    names = list(names)
+    ids = list(ids) if ids is not None else [None] * len(names)
+    if not (len(names) == len(ids) == matrix.shape[0]):
+        raise StoreError("encodings, names and ids must have the same length")
+
+    try:
+        version = int(read_sidecar(path).get("version", 0)) + 1
+    except StoreError:
+        version = 1
+
+    rows, dim = matrix.shape
+    payload = matrix.tobytes()
+
+    def _write_matrix(f):
+        f.write(_HEADER.pack(_MAGIC, FORMAT_VERSION, rows, dim).ljust(_HEADER_SIZE, b"\x00"))
+        f.write(payload)
+
+    meta = {
+        "format": FORMAT_VERSION,
+        "version": version,
+        "matrix": os.path.basename(matrix_path(path, version)),
+        "rows": rows,
+        "dim": dim,
+        "crc32": zlib.crc32(payload),
+        "names": names,
+        "ids": ids,
+    }
+    if extra:
+        meta.update(extra)
+
+    _replace_atomic(matrix_path(path, version), _write_matrix)
+    _replace_atomic(sidecar_path(path), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+    _remove_old_matrices(path, version)
+    return meta
+
+
+def load_store(path=STORE_PATH, verify=True):
+    """Map the store read-only. Returns (matrix, meta).
+
+    The matrix is a np.memmap view, so every process shares the same page
+    cache pages and nothing is copied at startup.
+    """
+    meta = read_sidecar(path)
+    rows, dim = int(meta["rows"]), int(meta["dim"])
+    fname = _matrix_file(path, meta)
+    try:
+        size = os.path.getsize(fname)
+        with open(fname, "rb") as f:
+            header = f.read(_HEADER.size)
+    except OSError as e:
+        raise StoreError(f"unreadable matrix {fname}: {e}")
+
+    if len(header) != _HEADER.size:
+        raise StoreError(f"{fname}: truncated header")
+    magic, fmt, h_rows, h_dim = _HEADER.unpack(header)
+    if magic != _MAGIC or fmt != FORMAT_VERSION:
+        raise StoreError(f"{fname}: not an encodings store")
+    if (h_rows, h_dim) != (rows, dim):
+        raise StoreError(f"{fname}: shape {h_rows}x{h_dim} does not match sidecar {rows}x{dim}")
+    if size != _HEADER_SIZE + rows * dim * 4:
+        raise StoreError(f"{fname}: expected {_HEADER_SIZE + rows * dim * 4} bytes, found {size}")
+    if len(meta.get("names", [])) != rows or len(meta.get("ids", [])) != rows:
+        raise StoreError(f"{sidecar_path(path)}: names/ids do not match {rows} rows")
+
+    if rows == 0:
+        return np.zeros((0, dim), dtype=np.float32), meta
+
+    matrix = np.memmap(fname, dtype="<f4", mode="r", offset=_HEADER_SIZE, shape=(rows, dim))
+    if verify and zlib.crc32(memoryview(matrix).cast("B")) != meta["crc32"]:
+        raise StoreError(f"{fname}: checksum mismatch (partial or foreign write)")
+    return matrix, meta
+
+
+def migrate_pickle(pickle_path="encodings.pickle", path=STORE_PATH):
+    # One-off import of the legacy {"encodings": [...], "names": [...]} pickle.
+    # Only run this on a file you produced yourself.
+    import pickle
+    with open(pickle_path, "rb") as f:
+        data = pickle.load(f)
+    return write_store(data.get("encodings", []), data.get("names", []), path=path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        src = sys.argv[2] if len(sys.argv) > 2 else "encodings.pickle"
+        meta = migrate_pickle(src)
+        print(f"[DONE] Migrated {meta['rows']} encodings from {src} to {matrix_path(version=meta['version'])}")
+    else:
+        matrix, meta = load_store()
+        print(f"store v{meta['version']}: {meta['rows']} x {meta['dim']} float32, crc32 ok")
@@ -0,0 +1,212 @@
+# face_index.py
+# Gallery search layer used by recognition.py.
+#
+#   brute  exact faces x gallery scan (default)
+#   ivf    inverted-file index: the gallery is partitioned with k-means and a
+#          query only scans the `nprobe` partitions whose centroids are
+#          closest, so work grows ~ sqrt(gallery) instead of linearly.
+#
+# The IVF partitions are persisted next to the encodings store as
+# <store>.ivf.npz and are tied to the store build version they were made from.
+import os
+import sys
+from collections import Counter
+import numpy as np
+import encodings_store
+
+INDEX_KIND = os.getenv("FACE_INDEX", "brute").lower()
+IVF_NPROBE = int(os.getenv("FACE_INDEX_NPROBE", "8"))
+IVF_MIN_ROWS = 2000  # below this a brute scan is already cheaper
+
+
+def index_path(path=encodings_store.STORE_PATH):
+    return path + ".ivf.npz"
+
+
+def squared_norms(matrix):
+    return np.einsum("ij,ij->i", matrix, matrix)
+
+
+def face_distance_matrix(face_encodings, gallery, gallery_norms):
+    """Euclidean distances between every face and every gallery row (faces x gallery).
+
+    Same metric as face_recognition.face_distance, computed with one float32
+    matrix product (|a|^2 + |b|^2 - 2ab) so numpy hands it to BLAS.
+    """
+    faces = np.asarray(face_encodings, dtype=np.float32).reshape(-1, gallery.shape[1])
+    sq = squared_norms(faces)[:, None] + gallery_norms[None, :] - 2.0 * (faces @ gallery.T)
+    np.maximum(sq, 0.0, out=sq)
+    return np.sqrt(sq, out=sq)
+
+
+def top_k(distances, k):
+    # Nearest k columns per row, sorted by distance
+    k = min(k, distances.shape[1])
+    if k < distances.shape[1]:
+        idx = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.broadcast_to(np.arange(k), distances.shape).copy()
+    dist = np.take_along_axis(distances, idx, axis=1)
+    order = np.argsort(dist, axis=1)
+    return np.take_along_axis(dist, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+
+class BruteForceIndex:
+    kind = "brute"
+
+    def __init__(self, gallery):
+        self.gallery = gallery
+        self.norms = squared_norms(gallery)
+
+    def __len__(self):
+        return self.gallery.shape[0]
+
+    def search(self, queries, k):
+        """Returns (distances, rows), each queries x k, nearest first."""
+        return top_k(face_distance_matrix(queries, self.gallery, self.norms), k)
+
+
+class IVFIndex:
+    kind = "ivf"
+
+    def __init__(self, gallery, centroids, order, offsets, nprobe=IVF_NPROBE, recall=None):
+        self.gallery = gallery
+        self.norms = squared_norms(gallery)
+        self.centroids = centroids
+        self.centroid_norms = squared_norms(centroids)
+        self.order = order      # gallery rows grouped by partition
+        self.offsets = offsets  # partition p is order[offsets[p]:offsets[p + 1]]
+        self.nprobe = nprobe
+        self.recall = recall
+
+    def __len__(self):
+        return self.gallery.shape[0]
+
+    @classmethod
+    def build(cls, gallery, n_lists=None, iterations=10, seed=0, nprobe=IVF_NPROBE):
+        n = gallery.shape[0]
+        n_lists = max(1, min(n, n_lists or int(np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        centroids = np.array(gallery[rng.choice(n, n_lists, replace=False)], dtype=np.float32)
+        norms = squared_norms(gallery)
+        for _ in range(iterations):
+            assign = np.argmin(face_distance_matrix(centroids, gallery, norms), axis=0)
+            counts = np.bincount(assign, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, gallery)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            # reseed empty partitions with random gallery rows
+            if empty.any():
+                centroids[empty] = gallery[rng.choice(n, int(empty.sum()), replace=False)]
+        assign = np.argmin(face_distance_matrix(centroids, gallery, norms), axis=0)
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))]).astype(np.int64)
+        return cls(gallery, centroids, order, offsets, nprobe=nprobe)
+
+    def _probe(self, lists, k):
+        # the nprobe nearest partitions, widened until they hold k rows
+        sizes = self.offsets[lists + 1] - self.offsets[lists]
+        n = max(min(self.nprobe, len(lists)), int(np.searchsorted(np.cumsum(sizes), k)) + 1)
+        return np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in lists[:n]])
+
+    def search(self, queries, k):
+        """Same contract as BruteForceIndex.search: min(k, rows) columns, nearest first."""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.gallery.shape[1])
+        k = min(k, self.gallery.shape[0])
+        _, lists = top_k(face_distance_matrix(queries, self.centroids, self.centroid_norms),
+                         self.centroids.shape[0])
+
+        out_dist = np.empty((queries.shape[0], k), dtype=np.float32)
+        out_rows = np.empty((queries.shape[0], k), dtype=np.int64)
+        for q in range(queries.shape[0]):
+            rows = self._probe(lists[q], k)
+            dist = face_distance_matrix(queries[q], self.gallery[rows], self.norms[rows])
+            d, c = top_k(dist, k)
+            out_dist[q] = d[0]
+            out_rows[q] = rows[c[0]]
+        return out_dist, out_rows
+
+    def save(self, path, store_version):
+        tmp = f"{index_path(path)}.tmp{os.getpid()}.npz"
+        np.savez(tmp, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                 store_version=np.int64(store_version),
+                 recall=np.float64(np.nan if self.recall is None else self.recall))
+        os.replace(tmp, index_path(path))
+
+    @classmethod
+    def load(cls, path, gallery, store_version, nprobe=IVF_NPROBE):
+        with np.load(index_path(path), allow_pickle=False) as data:
+            if int(data["store_version"]) != int(store_version):
+                raise encodings_store.StoreError("ivf index is stale for this encodings store")
+            recall = float(data["recall"])
+            return cls(gallery, data["centroids"], data["order"], data["offsets"], nprobe=nprobe,
+                       recall=None if np.isnan(recall) else recall)
+
+
+def measure_recall(index, gallery, ids=None, k=1, samples=500, seed=0):
+    """Recall@k of `index` against exact search, leave-one-out.
+
+    Queries are real gallery rows with their own row held out of both result
+    lists, so what has to be found is the nearest *other* encoding - another
+    photo of the same student where one exists. Rows of students enrolled
+    with more than one photo are preferred as queries.
+    """
+    n = gallery.shape[0]
+    if n < 2:
+        return 1.0
+    pool = np.arange(n)
+    if ids is not None:
+        counts = Counter(i for i in ids if i is not None)
+        multi = [r for r, i in enumerate(ids) if i is not None and counts[i] > 1]
+        if multi:
+            pool = np.asarray(multi)
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(pool, min(samples, len(pool)), replace=False)
+    queries = np.asarray(gallery[picks], dtype=np.float32)
+    _, exact = BruteForceIndex(gallery).search(queries, k + 1)
+    _, approx = index.search(queries, k + 1)
+    hits = total = 0
+    for row, e, a in zip(picks.tolist(), exact.tolist(), approx.tolist()):
+        e = [r for r in e if r != row][:k]
+        a = [r for r in a if r != row][:k]
+        hits += len(set(e) & set(a))
+        total += len(e)
+    return hits / float(total) if total else 1.0
+
+
+def build_index(path=encodings_store.STORE_PATH, kind=None):
+    """Rebuild the persisted index for the current store. Called by the encoding pipeline.
+
+    Returns a small report dict ({"kind", "rows", "recall"}).
+    """
+    kind = (kind or INDEX_KIND).lower()
+    if not encodings_store.exists(path):
+        return {"kind": "brute", "rows": 0, "recall": 1.0}
+    gallery, meta = encodings_store.load_store(path)
+    if kind != "ivf" or meta["rows"] < IVF_MIN_ROWS:
+        if os.path.exists(index_path(path)):
+            os.remove(index_path(path))
+        return {"kind": "brute", "rows": meta["rows"], "recall": 1.0}
+
+    index = IVFIndex.build(gallery)
+    index.recall = measure_recall(index, gallery, meta.get("ids"))
+    index.save(path, meta["version"])
+    return {"kind": "ivf", "rows": meta["rows"], "lists": int(index.centroids.shape[0]),
+            "nprobe": index.nprobe, "recall": round(index.recall, 4)}
+
+
+def load_index(gallery, meta, path=encodings_store.STORE_PATH, kind=None):
+    # Falls back to exact search whenever the ivf file is missing or stale
+    kind = (kind or INDEX_KIND).lower()
+    if kind == "ivf" and meta and os.path.exists(index_path(path)):
+        try:
+            return IVFIndex.load(path, gallery, meta["version"])
+        except (encodings_store.StoreError, OSError, KeyError, ValueError) as e:
+            print(f"❌ IVF index ignored: {e}")
+    return BruteForceIndex(gallery)
+
+
+if __name__ == "__main__":
+    report = build_index(kind=sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"[DONE] index {report}")
@@ -0,0 +1,266 @@
+# jobs.py
+# Asynchronous recognition jobs for /upload-photo?async=1.
+#
+# Uploads are accepted straight away and handed to a bounded queue that is
+# drained by a pool of recognition worker processes. Each job records when it
+# was queued, started and finished so queue wait and run time can be seen per
+# job; clients poll (or long-poll) /jobs/<job_id> for the result.
+#
+# A worker that dies (OOM on a huge photo, a dlib crash) breaks the whole
+# executor: its jobs fail and the pool is dropped, so the next submit starts
+# a fresh one instead of every later request failing.
+#
+# The photo or video a job works on is saved under JOB_UPLOAD_FOLDER and
+# deleted as soon as the job is over, however it ended.
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import metrics
+
+RECOGNITION_WORKERS = int(os.getenv("RECOGNITION_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "64"))  # queued + running jobs
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "900"))  # finished jobs are kept this long
+MAX_WAIT_SECONDS = 30
+BATCH_TIMEOUT_SECONDS = int(os.getenv("BATCH_TIMEOUT_SECONDS", "120"))
+JOB_UPLOAD_FOLDER = os.getenv("JOB_UPLOAD_FOLDER", os.path.join("uploads", "jobs"))
+
+job_wait_seconds = metrics.histogram("attendance_job_wait_seconds", "Time jobs spent queued before a worker took them")
+job_run_seconds = metrics.histogram("attendance_job_run_seconds", "Time jobs spent running in a worker")
+job_queue_depth = metrics.histogram("attendance_job_queue_depth", "Queued and running jobs when a job is accepted",
+                                    buckets=metrics.COUNT_BUCKETS)
+
+
+class QueueFull(Exception):
+    pass
+
+
+def upload_path(filename):
+    """Unique path under JOB_UPLOAD_FOLDER for a job's input file."""
+    os.makedirs(JOB_UPLOAD_FOLDER, exist_ok=True)
+    return os.path.join(JOB_UPLOAD_FOLDER, f"{uuid.uuid4().hex}_{filename}")
+
+
+def discard_upload(path):
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _init_worker(workers):
+    # Each worker keeps its own gallery snapshot fresh, and buffers its
+    # stage timings so they travel back with each result. The snapshot
+    # inherited from the parent is from whenever the pool forked, so catch
+    # up first; the parent's watcher thread does not exist in the child.
+    # Tiled photos split the CPUs between the workers rather than each
+    # forking a tile process per core.
+    metrics.buffer_observations()
+    from detection import limit_tile_workers
+    limit_tile_workers((os.cpu_count() or 1) // workers)
+    from recognition import reload_encodings, start_gallery_watcher
+    reload_encodings()
+    start_gallery_watcher()
+
+
+def _run_recognition(image_path, kwargs):
+    from recognition import recognize_faces_in_image
+    started = time.time()
+    try:
+        results = recognize_faces_in_image(image_path, **kwargs)
+    finally:
+        # a failed job's timings are dropped rather than left for the next job to return
+        observations = metrics.drain()
+    return started, time.time(), results, observations
+
+
+def run_video_job(video_path, kwargs):
+    from video import process_video
+    started = time.time()
+    try:
+        summary = process_video(video_path, **kwargs)
+    finally:
+        observations = metrics.drain()
+    return started, time.time(), summary, observations
+
+
+class JobQueue:
+    def __init__(self, workers=RECOGNITION_WORKERS, max_depth=JOB_QUEUE_SIZE, ttl=JOB_TTL_SECONDS,
+                 task=_run_recognition):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.ttl = ttl
+        self.task = task
+        self._pool = None
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                 initargs=(self.workers,))
+            return self._pool
+
+    def _drop_pool(self, pool):
+        """Forget a broken executor so the next submit builds a new one."""
+        with self._lock:
+            if self._pool is not pool:
+                return  # already replaced
+            self._pool = None
+        pool.shutdown(wait=False)
+
+    def depth(self):
+        with self._lock:
+            return sum(1 for j in self._jobs.values() if j["status"] in ("queued", "running"))
+
+    def submit(self, *args, upload=None, **meta):
+        """Queue task(*args); returns the job dict. Raises QueueFull when at capacity.
+
+        `upload` is a file deleted once the job has finished or failed; when
+        the job is refused, the caller removes it (discard_upload).
+        """
+        return self.submit_call(self.task, args, upload=upload, **meta)
+
+    def submit_call(self, task, args, upload=None, **meta):
+        """Like submit(), for a task other than the queue's default one."""
+        return self._submit(task, [args], [upload], meta)[0]
+
+    def submit_batch(self, args_list, uploads=None, **meta):
+        """submit() for several jobs at once: either all are queued or, when
+        the queue cannot take them all, none are and QueueFull is raised."""
+        return self._submit(self.task, args_list, uploads or [None] * len(args_list), meta)
+
+    def _submit(self, task, args_list, uploads, meta):
+        with self._lock:
+            self._expire()
+            depth = sum(1 for j in self._jobs.values() if j["status"] in ("queued", "running"))
+            if depth + len(args_list) > self.max_depth:
+                raise QueueFull(f"recognition queue is full ({depth} jobs, {len(args_list)} more requested)")
+            jobs = []
+            for args, upload in zip(args_list, uploads):
+                depth += 1
+                job = {
+                    "job_id": uuid.uuid4().hex,
+                    "status": "queued",
+                    "submitted_at": time.time(),
+                    "started_at": None,
+                    "finished_at": None,
+                    "queue_depth": depth,  # depth when this job was accepted
+                    "result": None,
+                    "error": None,
+                    "meta": meta,
+                    "_done": threading.Event(),
+                    "_future": None,
+                    "_upload": upload,
+                }
+                self._jobs[job["job_id"]] = job
+                jobs.append((job, args))
+        views = []
+        for n, (job, args) in enumerate(jobs):
+            job_queue_depth.observe(job["queue_depth"])
+            try:
+                pool, future = self._start(task, args, retry=n == 0)
+            except BrokenProcessPool:
+                # jobs already submitted fail through _finish; the rest never ran
+                self._abandon(jobs[n:])
+                raise
+            job["_future"] = future
+            future.add_done_callback(lambda f, job=job, pool=pool: self._finish(job, f, pool))
+            views.append(self.view(job))
+        return views
+
+    def _start(self, task, args, retry):
+        pool = self._get_pool()
+        try:
+            return pool, pool.submit(task, *args)
+        except BrokenProcessPool:
+            self._drop_pool(pool)
+            if not retry:
+                raise
+        # the pool broke before this call submitted anything: a fresh one can take it all
+        return self._start(task, args, retry=False)
+
+    def _abandon(self, jobs):
+        # jobs registered by _submit that never reached a worker; finished
+        # so that _expire drops them and they stop counting towards max_depth
+        with self._lock:
+            for job, _ in jobs:
+                job.update(status="failed", finished_at=time.time(), error="recognition workers died")
+        for job, _ in jobs:
+            discard_upload(job["_upload"])
+            job["_done"].set()
+
+    def _finish(self, job, future, pool):
+        with self._lock:
+            try:
+                started, finished, result, observations = future.result()
+                job.update(status="done", started_at=started, finished_at=finished, result=result)
+            except Exception as e:
+                job.update(status="failed", finished_at=time.time(), error=str(e) or type(e).__name__)
+                observations = ()
+        discard_upload(job["_upload"])
+        job["_done"].set()
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._drop_pool(pool)
+        metrics.replay(observations)
+        if job["started_at"]:
+            job_wait_seconds.observe(job["started_at"] - job["submitted_at"])
+            job_run_seconds.observe(job["finished_at"] - job["started_at"])
+
+    def get(self, job_id, wait=0):
+        """Current view of a job, optionally blocking up to `wait` seconds for it to finish."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if wait > 0:
+            job["_done"].wait(min(wait, MAX_WAIT_SECONDS))
+        return self.view(job)
+
+    def wait_all(self, job_ids, timeout):
+        """Block until every job is finished or `timeout` seconds pass; returns their views."""
+        deadline = time.time() + timeout
+        with self._lock:
+            jobs = [self._jobs.get(job_id) for job_id in job_ids]
+        for job in jobs:
+            if job is not None:
+                job["_done"].wait(max(0.0, deadline - time.time()))
+        return [self.view(job) if job is not None else None for job in jobs]
+
+    def view(self, job):
+        with self._lock:
+            status = job["status"]
+            future = job["_future"]
+            if status == "queued" and future is not None and future.running():
+                status = "running"
+            now = time.time()
+            started = job["started_at"]
+            out = {
+                "job_id": job["job_id"],
+                "status": status,
+                "queue_depth": job["queue_depth"],
+                "submitted_at": job["submitted_at"],
+                "started_at": started,
+                "finished_at": job["finished_at"],
+                "wait_seconds": round((started or now) - job["submitted_at"], 3) if status != "queued"
+                                else round(now - job["submitted_at"], 3),
+                "run_seconds": round(job["finished_at"] - started, 3) if started and job["finished_at"] else None,
+            }
+            if status == "done":
+                out["result"] = job["result"]
+            if status == "failed":
+                out["error"] = job["error"]
+            out.update(job["meta"])
+            return out
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [k for k, j in self._jobs.items() if j["finished_at"] and j["finished_at"] < cutoff]:
+            del self._jobs[job_id]
+
+
+recognition_jobs = JobQueue()
@@ -0,0 +1,207 @@
+# log_reader.py
+# Paged, seekable access to system.log and the `logs` table.
+#
+# File entries are addressed by byte offset: the latest N lines are found by
+# reading fixed-size blocks backwards from the end, older pages continue
+# backwards from an offset, and followers read forwards from the offset they
+# last saw. Nothing ever reads the whole file. The `logs` table is paged by
+# log_id (keyset), newest first.
+import os
+import re
+import json
+import time
+from datetime import datetime
+from db import get_connection
+
+LOG_FILE = os.getenv("SYSTEM_LOG_FILE", "system.log")
+BLOCK_SIZE = 64 * 1024
+MAX_LINE_BYTES = 16 * 1024       # longer lines are cut when displayed
+DEFAULT_LIMIT = 200
+MAX_LIMIT = 2000
+STREAM_POLL_SECONDS = 1.0
+STREAM_MAX_SECONDS = 300         # clients reconnect with Last-Event-ID
+STREAM_HEARTBEAT_SECONDS = 15
+
+# "2025-09-24 17:38:08,123 - INFO - msg", "[2025-09-24T17:38:08] ERROR: msg", "WARNING:werkzeug:msg", ...
+_TIMESTAMP = re.compile(r"(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})(?:[.,](\d{1,6}))?")
+_LEVEL = re.compile(r"\b(DEBUG|INFO|WARNING|WARN|ERROR|CRITICAL|FATAL)\b")
+_LEVELS = {"WARN": "warning", "FATAL": "critical"}
+
+
+def parse_line(raw, offset):
+    text = raw.decode("utf-8", errors="replace").rstrip("\r\n")
+    if len(text) > MAX_LINE_BYTES:
+        text = text[:MAX_LINE_BYTES] + "…"
+    log_time = None
+    m = _TIMESTAMP.search(text, 0, 64)
+    if m:
+        try:
+            log_time = datetime.strptime(f"{m.group(1)} {m.group(2)}", "%Y-%m-%d %H:%M:%S")
+            if m.group(3):
+                log_time = log_time.replace(microsecond=int(m.group(3).ljust(6, "0")))
+            log_time = log_time.isoformat()
+        except ValueError:
+            log_time = None
+    level = _LEVEL.search(text, 0, 96)
+    level = level.group(1) if level else "INFO"
+    return {
+        "log_id": offset,
+        "offset": offset,
+        "log_time": log_time,
+        "log_type": _LEVELS.get(level, level.lower()),
+        "category": "system",
+        "message": text,
+    }
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def read_before(path=LOG_FILE, before=None, limit=DEFAULT_LIMIT):
+    """Up to `limit` complete lines ending at byte `before` (default: end of file).
+
+    Returns (entries oldest first, offset of the first entry or None when the
+    start of the file was reached, end offset).
+    """
+    size = _size(path)
+    end = size if before is None or before > size else before
+    if end == 0:
+        return [], None, size
+    with open(path, "rb") as f:
+        pos, buf = end, b""
+        # need limit + 1 newlines so the first kept line is known to be complete
+        while pos > 0 and buf.count(b"\n") <= limit:
+            step = min(BLOCK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+    i = 0
+    if pos > 0:
+        i = buf.find(b"\n") + 1  # partial line at the front belongs to the previous page
+    lines = []
+    while i < len(buf):
+        j = buf.find(b"\n", i)
+        if j == -1:
+            j = len(buf)
+        lines.append((pos + i, buf[i:j]))
+        i = j + 1
+    lines = lines[-limit:]
+    entries = [parse_line(line, start) for start, line in lines]
+    first = entries[0]["offset"] if entries else end
+    return entries, (first if first > 0 else None), size
+
+
+def read_after(path=LOG_FILE, offset=0, limit=DEFAULT_LIMIT):
+    """Complete lines from byte `offset` forwards.
+
+    Returns (entries, offset to continue from). A file that shrank below
+    `offset` (rotated or truncated) is read again from the start.
+    """
+    size = _size(path)
+    if offset > size:
+        offset = 0
+    if offset == size:
+        return [], offset
+    entries = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while len(entries) < limit:
+            line = f.readline()
+            if not line or not line.endswith(b"\n"):
+                break  # nothing more, or a line still being written
+            entries.append(parse_line(line, offset))
+            offset += len(line)
+    return entries, offset
+
+
+def page_db_logs(log_type=None, before_id=None, after_id=None, limit=DEFAULT_LIMIT):
+    """Rows of the `logs` table by keyset.
+
+    `before_id` pages backwards (newest first); `after_id` returns rows newer
+    than it (oldest first), which is what a follower needs.
+    """
+    where, args = [], []
+    if log_type:
+        where.append("log_type = %s")
+        args.append(log_type)
+    if before_id is not None:
+        where.append("log_id < %s")
+        args.append(before_id)
+    if after_id is not None:
+        where.append("log_id > %s")
+        args.append(after_id)
+    clause = ("WHERE " + " AND ".join(where)) if where else ""
+    order = "ASC" if after_id is not None else "DESC"
+    conn = get_connection()
+    if conn is None:
+        raise RuntimeError("DB connection failed")
+    try:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(f"""SELECT log_id, log_type, message, log_time FROM logs {clause}
+                           ORDER BY log_id {order} LIMIT %s""", args + [limit])
+        rows = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+    for row in rows:
+        row["log_time"] = row["log_time"].isoformat() if row["log_time"] else None
+        row["category"] = "database"
+    return rows
+
+
+def latest_db_log_id():
+    rows = page_db_logs(limit=1)
+    return rows[0]["log_id"] if rows else 0
+
+
+def _event(event, data, event_id):
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_events(path=LOG_FILE, offset=None, db_after=None, log_type=None,
+                  max_seconds=STREAM_MAX_SECONDS, poll=STREAM_POLL_SECONDS):
+    """Server-sent events for new file lines and new `logs` rows.
+
+    Every event id is "<file offset>:<last log_id>", so a reconnecting client
+    sends it back as Last-Event-ID and resumes exactly where it stopped.
+    """
+    offset = _size(path) if offset is None else offset
+    if db_after is None:
+        try:
+            db_after = latest_db_log_id()
+        except RuntimeError:
+            db_after = 0
+    yield "retry: 2000\n\n"
+    started = last_sent = time.time()
+    while time.time() - started < max_seconds:
+        entries, offset = read_after(path, offset, MAX_LIMIT)
+        try:
+            rows = page_db_logs(log_type=log_type, after_id=db_after, limit=MAX_LIMIT)
+        except RuntimeError:
+            rows = []
+        if rows:
+            db_after = rows[-1]["log_id"]
+        if entries or rows:
+            cursor = f"{offset}:{db_after}"
+            for entry in entries:
+                yield _event("system", entry, cursor)
+            for row in rows:
+                yield _event("database", row, cursor)
+            last_sent = time.time()
+        elif time.time() - last_sent >= STREAM_HEARTBEAT_SECONDS:
+            yield ": keep-alive\n\n"
+            last_sent = time.time()
+        time.sleep(poll)
+
+
+def parse_event_id(value):
+    """(file offset, last log_id) from a Last-Event-ID value; (None, None) if absent or malformed."""
+    try:
+        offset, log_id = str(value).split(":")
+        return int(offset), int(log_id)
+    except (TypeError, ValueError):
+        return None, None
@@ -0,0 +1,185 @@
+# metrics.py
+# In-process latency spans, histograms and gauges, rendered in the
+# Prometheus text format for /metrics.
+#
+# Recording is a perf_counter() pair, one bisect and a short lock per
+# observation, cheap enough to leave on (METRICS_ENABLED=0 turns it off).
+# Recognition runs in worker processes whose registries the server never
+# sees, so workers buffer their observations and hand them back with each
+# job result; the server replays them into its own registry.
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = list(zip(labelnames, key)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._series = {}  # label key -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        key = _label_key(self.labelnames, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += value
+        if _buffer is not None:
+            _buffer.append((self.name, labels, value))
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, key, ("le", le)), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, key), round(series[-1], 6)
+            yield f"{self.name}_count", _format_labels(self.labelnames, key), cumulative
+
+
+class Gauge:
+    """Read at scrape time from a callback returning a number or {label value: number}."""
+    kind = "gauge"
+
+    def __init__(self, name, help, read, labelname=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labelname = labelname
+
+    def samples(self):
+        try:
+            value = self.read()
+        except Exception:
+            return
+        if isinstance(value, dict):
+            for label, v in sorted(value.items()):
+                yield self.name, _format_labels((self.labelname,), (label,)), v
+        elif value is not None:
+            yield self.name, "", value
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+_buffer = None  # list of (name, labels, value) in worker processes
+
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, labelnames=()):
+    return _register(Histogram(name, help, buckets, labelnames))
+
+
+def gauge(name, help, read, labelname=None):
+    with _registry_lock:
+        metric = Gauge(name, help, read, labelname)
+        _registry[name] = metric  # re-registering replaces the callback
+        return metric
+
+
+stage_seconds = histogram("attendance_stage_seconds", "Time spent per processing stage", labelnames=("stage",))
+
+
+@contextmanager
+def span(stage):
+    """Time a block as one observation of attendance_stage_seconds{stage=...}."""
+    if not ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage)
+
+
+def record(stage, seconds):
+    """An already-measured duration, for stages that time themselves."""
+    stage_seconds.observe(seconds, stage=stage)
+
+
+def timed(stage):
+    """Decorator form of span()."""
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def buffer_observations():
+    # called in worker processes; see drain()/replay()
+    global _buffer
+    _buffer = []
+
+
+def drain():
+    """Observations buffered since the last drain (empty outside workers)."""
+    global _buffer
+    if _buffer is None:
+        return []
+    out, _buffer = _buffer, []
+    return out
+
+
+def replay(observations):
+    for name, labels, value in observations or ():
+        metric = _registry.get(name)
+        if isinstance(metric, Histogram):
+            metric.observe(value, **labels)
+
+
+def render():
+    lines = []
+    with _registry_lock:
+        metrics = list(_registry.values())
+    for metric in metrics:
+        samples = list(metric.samples())
+        if not samples:
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in samples:
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,202 @@
+# migrate.py
+# Versioned schema migrations for the attendance database.
+#
+# Migrations are the numbered .sql files in migrations/ (NNNN_description.sql)
+# and are applied in order, each recorded in `schema_migrations` with the
+# file's checksum. `explain` prints MySQL's plan for the SQL behind each
+# route, and `up --explain` prints them before and after applying, so a new
+# index can be seen to be picked up.
+#
+#   python migrate.py status
+#   python migrate.py up [--explain]
+#   python migrate.py mark 0002     # record 0001..0002 as already applied by hand
+#   python migrate.py explain
+import os
+import re
+import sys
+import zlib
+import datetime
+from db import get_connection
+from attendance_export import DEFAULT_COLUMNS, build_query
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+_NAME = re.compile(r"^(\d{4})_(.+)\.sql$")
+
+# SQL of the request paths that matter for latency, with representative arguments
+_day = datetime.date.today()
+_month_ago = _day - datetime.timedelta(days=30)
+QUERY_PATHS = {
+    "export (date range + section)": build_query(
+        DEFAULT_COLUMNS, {"date_from": _month_ago, "date_to": _day, "section": "A"}),
+    "export (everything)": build_query(DEFAULT_COLUMNS, {}),
+    "attendance-report page": (
+        """SELECT section, date, present, absent FROM attendance_daily_summary
+           WHERE date >= %s AND date <= %s ORDER BY date DESC, section ASC LIMIT 100""",
+        [_month_ago, _day]),
+    "summary recount (section, day)": (
+        """SELECT COALESCE(s.section, ''), a.date, SUM(a.status = 'Present'), SUM(a.status = 'Absent')
+           FROM attendance a JOIN students s ON a.student_id = s.student_id
+           WHERE (s.section IN (%s)) AND a.date = %s
+           GROUP BY COALESCE(s.section, ''), a.date""",
+        ["A", _day]),
+    "student history (date range)": (
+        """SELECT date, status FROM attendance
+           WHERE student_id = %s AND date BETWEEN %s AND %s ORDER BY date""",
+        [1, _month_ago, _day]),
+    "roster class lookup": (
+        "SELECT student_id FROM students WHERE branch = %s AND section = %s AND year = %s",
+        ["CSE", "A", 2]),
+}
+
+
+def discover(folder=MIGRATIONS_DIR):
+    """[(version, name, path)] sorted by version."""
+    found = []
+    for fname in sorted(os.listdir(folder)):
+        m = _NAME.match(fname)
+        if m:
+            found.append((m.group(1), m.group(2), os.path.join(folder, fname)))
+    return found
+
+
+def split_statements(sql):
+    # Migrations are plain DDL/DML: no procedures, so ';' at end of line ends a statement
+    body = "\n".join(line for line in sql.splitlines() if not line.strip().startswith("--"))
+    return [stmt.strip() for stmt in re.split(r";\s*(?:\n|$)", body) if stmt.strip()]
+
+
+def _checksum(path):
+    with open(path, "rb") as f:
+        return format(zlib.crc32(f.read()), "08x")
+
+
+def _ensure_table(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+        version char(4) NOT NULL PRIMARY KEY,
+        name varchar(255) NOT NULL,
+        checksum char(8) NOT NULL,
+        applied_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )""")
+
+
+def applied(cursor):
+    _ensure_table(cursor)
+    cursor.execute("SELECT version, checksum FROM schema_migrations")
+    return dict(cursor.fetchall())
+
+
+def _connect():
+    conn = get_connection()
+    if conn is None:
+        sys.exit("❌ Database connection failed")
+    return conn
+
+
+def status():
+    conn = _connect()
+    cursor = conn.cursor()
+    try:
+        done = applied(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+    for version, name, path in discover():
+        state = "pending"
+        if version in done:
+            state = "applied" if done[version] == _checksum(path) else "applied (file changed since)"
+        print(f"{version}  {name:45s} {state}")
+
+
+def up(explain=False):
+    if explain:
+        print("== Query plans before ==")
+        explain_all()
+    conn = _connect()
+    cursor = conn.cursor()
+    ran = 0
+    try:
+        done = applied(cursor)
+        for version, name, path in discover():
+            if version in done:
+                continue
+            with open(path, encoding="utf-8") as f:
+                statements = split_statements(f.read())
+            print(f"[INFO] Applying {version}_{name} ({len(statements)} statements)")
+            # MySQL commits DDL implicitly, so a failed migration is not rolled
+            # back; it stays unrecorded and is reported with the failing statement
+            for stmt in statements:
+                try:
+                    cursor.execute(stmt)
+                    if cursor.with_rows:
+                        cursor.fetchall()
+                except Exception as e:
+                    conn.rollback()
+                    sys.exit(f"❌ {version}_{name} failed: {e}\n{stmt}")
+            cursor.execute("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                           (version, name, _checksum(path)))
+            conn.commit()
+            ran += 1
+    finally:
+        cursor.close()
+        conn.close()
+    print(f"[DONE] {ran} migration(s) applied")
+    if explain:
+        print("== Query plans after ==")
+        explain_all()
+
+
+def mark(through):
+    """Record every migration up to `through` as applied without running it."""
+    conn = _connect()
+    cursor = conn.cursor()
+    try:
+        done = applied(cursor)
+        for version, name, path in discover():
+            if version > through:
+                break
+            if version not in done:
+                cursor.execute("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                               (version, name, _checksum(path)))
+                print(f"[INFO] Marked {version}_{name} as applied")
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def explain(cursor, sql, args):
+    cursor.execute("EXPLAIN " + sql, args)
+    return cursor.fetchall()
+
+
+def explain_all(paths=QUERY_PATHS):
+    conn = _connect()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        for label, (sql, args) in paths.items():
+            print(f"-- {label}")
+            try:
+                rows = explain(cursor, sql, args)
+            except Exception as e:
+                print(f"   (not available: {e})")
+                continue
+            for r in rows:
+                print(f"   {str(r['table']):>26s}  type={r['type'] or '-':6s} key={r['key'] or '-':32s} "
+                      f"rows={r['rows'] or '-':<8} {r['Extra'] or ''}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["status"]:
+        status()
+    elif args[:1] == ["up"]:
+        up(explain="--explain" in args)
+    elif args[:1] == ["mark"] and len(args) == 2:
+        mark(args[1])
+    elif args[:1] == ["explain"]:
+        explain_all()
+    else:
+        print("usage: python migrate.py status | up [--explain] | mark NNNN | explain")
@@ -0,0 +1,12 @@
+-- 0001: one attendance row per student per day, so bulk writes can upsert.
+-- Apply with: python migrate.py up
+
+-- keep the most recent row for any (student_id, date) that was recorded twice
+DELETE a FROM attendance a
+JOIN attendance b
+  ON a.student_id = b.student_id
+ AND a.date = b.date
+ AND a.attendance_id < b.attendance_id;
+
+ALTER TABLE attendance
+  ADD UNIQUE KEY uq_attendance_student_date (student_id, date);
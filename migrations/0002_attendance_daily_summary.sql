@@ -0,0 +1,21 @@
+-- 0002: per-section, per-day attendance counts for /attendance-report.
+-- Kept current by db.save_attendance_bulk(); recount any time with
+--   python db.py rebuild-summary
+-- Apply with: python migrate.py up
+
+CREATE TABLE IF NOT EXISTS attendance_daily_summary (
+  section varchar(50) NOT NULL DEFAULT '',
+  date date NOT NULL,
+  present int NOT NULL DEFAULT 0,
+  absent int NOT NULL DEFAULT 0,
+  PRIMARY KEY (date, section),
+  KEY idx_summary_section_date (section, date)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+DELETE FROM attendance_daily_summary;
+
+INSERT INTO attendance_daily_summary (section, date, present, absent)
+SELECT COALESCE(s.section, ''), a.date, SUM(a.status = 'Present'), SUM(a.status = 'Absent')
+FROM attendance a
+JOIN students s ON a.student_id = s.student_id
+GROUP BY COALESCE(s.section, ''), a.date;
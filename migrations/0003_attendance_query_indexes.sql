@@ -0,0 +1,16 @@
+-- 0003: indexes for the report, export and roll-call query paths.
+-- Apply with: python migrate.py up
+
+-- exports and summary recounts range over date, then join to students
+ALTER TABLE attendance
+  ADD KEY idx_attendance_date_student (date, student_id);
+
+-- uq_attendance_student_date (0001) starts with student_id and serves the
+-- foreign key, so the single-column key is redundant
+ALTER TABLE attendance
+  DROP KEY student_id;
+
+-- class filters in exports, roll calls and summary recounts
+ALTER TABLE students
+  ADD KEY idx_students_branch_section_year (branch, section, year),
+  ADD KEY idx_students_section (section);
@@ -0,0 +1,9 @@
+-- 0004: change stamp for the students table.
+-- Apply with: python migrate.py up
+
+-- /students derives its ETag from COUNT(*) and MAX(updated_at), which every
+-- server process sees the same; microseconds so two edits in one second
+-- still produce different tags
+ALTER TABLE students
+  ADD COLUMN updated_at timestamp(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+  ADD KEY idx_students_updated_at (updated_at);
@@ -1,83 +1,388 @@
 # recognition.py
 import os
-import pickle
 import numpy as np
 import face_recognition
-import cv2
-import datetime
-from db import get_connection  # your database connection
-
-ENCODINGS_FILE = "encodings.pickle"
-UNKNOWN_FACES_DIR = "uploads/unknown_faces"
+import threading
+import time
+import encodings_store
+import face_index
+import detection
+import result_cache
+import unknown_faces
+import metrics
+from metrics import span
+from roster import roster, class_key
+
+ENCODINGS_FILE = encodings_store.STORE_PATH
+UNKNOWN_FACES_DIR = unknown_faces.UNKNOWN_FACES_DIR
   
 # make sure the folder exists
 os.makedirs(UNKNOWN_FACES_DIR, exist_ok=True)
 
-def load_encodings():
-    if not os.path.exists(ENCODINGS_FILE): 
-        return {"encodings": [], "names": []}
-    with open(ENCODINGS_FILE, "rb") as f:
-        data = pickle.load(f)
-    return data
+def _read_store():
+    matrix, meta = encodings_store.load_store(ENCODINGS_FILE)
+    return {"encodings": matrix, "names": meta["names"], "ids": meta["ids"], "version": meta["version"], "meta": meta}
 
-_data = load_encodings()
-KNOWN_ENCODINGS = np.array(_data.get("encodings", []))
-KNOWN_NAMES = list(_data.get("names", []))
+def load_encodings():
+    """The current store, an empty gallery if none was built yet, or None if
+    the store is unreadable (e.g. caught mid-write)."""
+    if not encodings_store.exists(ENCODINGS_FILE):
+        return {"encodings": [], "names": [], "ids": []}
+    try:
+        return _read_store()
+    except encodings_store.StoreError as e:
+        print(f"❌ Encodings store rejected: {e}")
+        return None
+
+MATCH_CANDIDATES = 8  # gallery rows considered per face during assignment
+ROWS_BUCKETS = (0, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+faces_per_image = metrics.histogram("attendance_faces_per_image", "Faces detected per recognised image",
+                                    buckets=metrics.COUNT_BUCKETS)
+gallery_rows_searched = metrics.histogram("attendance_gallery_rows_searched",
+                                          "Gallery (or partition) rows each match searched", buckets=ROWS_BUCKETS)
+GALLERY_POLL_SECONDS = float(os.getenv("GALLERY_POLL_SECONDS", "5"))
+
+class GallerySnapshot:
+    """One immutable, versioned view of the known faces.
+
+    A request grabs the current snapshot once (get_gallery()) and uses it
+    for its whole lifetime; reloads build a new snapshot and swap the
+    module reference in a single assignment, so encodings and names can
+    never come from different builds.
+    """
+    __slots__ = ("version", "index", "names", "ids", "keys", "loaded_at")
+
+    def __init__(self, version, index, names, ids):
+        self.version = version
+        self.index = index
+        self.names = tuple(names)
+        self.ids = tuple(ids)
+        self.keys = tuple(student_key(i, n) for i, n in zip(self.ids, self.names))
+        self.loaded_at = time.time()
+
+    @property
+    def encodings(self):
+        return self.index.gallery
+
+    @property
+    def size(self):
+        return len(self.names)
+
+def student_key(student_id, name):
+    """Identity of a matched student: names are not unique, so the name only
+    stands in for rows built without a student_id (the folder build)."""
+    return ("id", int(student_id)) if student_id is not None else ("name", name)
+
+def _build_snapshot(data):
+    # memmapped float32 store rows pass through without a copy
+    gallery = np.ascontiguousarray(np.asarray(data.get("encodings", []), dtype=np.float32))
+    if gallery.ndim != 2:
+        gallery = gallery.reshape(0, encodings_store.ENCODING_DIM)
+    gallery.flags.writeable = False
+    index = face_index.load_index(gallery, data.get("meta"), ENCODINGS_FILE)
+    names = data.get("names", [])
+    ids = data.get("ids") or [None] * len(names)
+    return GallerySnapshot(data.get("version", 0), index, names, ids)
+
+_gallery = _build_snapshot(load_encodings() or {})
+_reload_lock = threading.Lock()
+
+def get_gallery():
+    return _gallery
 
 def reload_encodings():
-    global _data, KNOWN_ENCODINGS, KNOWN_NAMES
-    _data = load_encodings()
-    KNOWN_ENCODINGS = np.array(_data.get("encodings", []))
-    KNOWN_NAMES = list(_data.get("names", []))
-    return len(KNOWN_NAMES)
-
-def log_unknown_face(filename, error_message):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO logs (log_type, message) VALUES (%s, %s)",
-        ("UnknownFace", f"{filename}: {error_message}")
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-def recognize_faces_in_image(image_path, tolerance=0.45, model='hog'):
-    image = face_recognition.load_image_file(image_path)
-    face_locations = face_recognition.face_locations(image, model=model)
-    face_encodings = face_recognition.face_encodings(image, face_locations)
-
+    # An unreadable store keeps the current snapshot; the watcher swaps in
+    # the finished build once the writer is done
+    global _gallery
+    data = load_encodings()
+    if data is None:
+        return _gallery.size
+    snapshot = _build_snapshot(data)
+    with _reload_lock:
+        _gallery = snapshot
+    return _gallery.size
+
+def _store_signature():
+    sig = []
+    # matrix files are never rewritten in place: a new one comes with a new sidecar
+    for fname in (encodings_store.sidecar_path(ENCODINGS_FILE), face_index.index_path(ENCODINGS_FILE)):
+        try:
+            st = os.stat(fname)
+            sig.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append(None)
+    return tuple(sig)
+
+_watcher = None
+_watcher_pid = None
+
+def start_gallery_watcher(interval=GALLERY_POLL_SECONDS):
+    """Poll the store files and hot-swap the gallery when a new build lands.
+
+    Safe to call more than once per process; only one watcher thread runs.
+    A forked child inherits the parent's thread object but not the thread,
+    so it gets a watcher of its own.
+    A half-written store is rejected by the loader and retried next tick,
+    while requests keep using the snapshot they already hold.
+    """
+    global _watcher, _watcher_pid
+    if interval <= 0:
+        return _watcher
+    if _watcher is not None and _watcher_pid == os.getpid() and _watcher.is_alive():
+        return _watcher
+
+    def _watch():
+        global _gallery
+        last = _store_signature()
+        while True:
+            time.sleep(interval)
+            sig = _store_signature()
+            if sig == last:
+                continue
+            try:
+                snapshot = _build_snapshot(_read_store())
+            except encodings_store.StoreError as e:
+                print(f"❌ Gallery reload deferred: {e}")
+                continue
+            with _reload_lock:
+                _gallery = snapshot
+            last = sig
+            print(f"[INFO] Gallery v{snapshot.version} loaded ({snapshot.size} encodings)")
+
+    _watcher = threading.Thread(target=_watch, name="gallery-watcher", daemon=True)
+    _watcher_pid = os.getpid()
+    _watcher.start()
+    return _watcher
+
+# ---- Section partitions ----
+# A teacher's upload for one class only needs that class's rows. Partitions
+# are small brute-force sub-galleries cut from the current snapshot by the
+# roster's class membership; they are rebuilt whenever either the gallery or
+# the roster changes version.
+MAX_PARTITIONS = int(os.getenv("GALLERY_MAX_PARTITIONS", "64"))
+_partitions = {}
+_partition_ids = {}  # student_id per row of the current gallery
+_partitions_lock = threading.Lock()
+
+def _reset_after_fork():
+    # A lock held by one of the parent's threads at fork time would stay
+    # locked forever in the child, which has no such thread
+    global _reload_lock, _partitions_lock
+    _reload_lock = threading.Lock()
+    _partitions_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _gallery_id_array(gallery):
+    # rows without a student_id never belong to a class
+    return np.array([-1 if i is None else int(i) for i in gallery.ids], dtype=np.int64)
+
+def get_partition(gallery, branch=None, section=None, year=None):
+    """Sub-gallery of the students in one branch/section/year.
+
+    With no filters this is the gallery itself. Partition versions are
+    distinct from the full gallery's, so cached matches never mix the two.
+    """
+    key = class_key(branch, section, year)
+    if not any(key):
+        return gallery
+    students = roster.get()
+    cache_key = (gallery.version, students.version, key)
+    with _partitions_lock:
+        part = _partitions.get(cache_key)
+        if part is not None:
+            return part
+        for k in [k for k in _partitions if k[:2] != cache_key[:2]]:
+            del _partitions[k]
+        if _partition_ids.get("version") != gallery.version:
+            _partition_ids.update(version=gallery.version, ids=_gallery_id_array(gallery))
+        id_array = _partition_ids["ids"]
+
+    rows = np.flatnonzero(np.isin(id_array, students.class_ids(branch, section, year)))
+    sub = np.ascontiguousarray(gallery.encodings[rows])
+    sub.flags.writeable = False
+    part = GallerySnapshot(cache_key, face_index.BruteForceIndex(sub),
+                           [gallery.names[r] for r in rows], [gallery.ids[r] for r in rows])
+    with _partitions_lock:
+        if len(_partitions) >= MAX_PARTITIONS:
+            _partitions.clear()
+        _partitions[cache_key] = part
+    return part
+
+def assign_matches(cand_dist, cand_idx, keys, tolerance):
+    """One-to-one assignment of faces to students.
+
+    Candidate pairs within tolerance are taken greedily from the closest up,
+    so a student (who may own several gallery rows; `keys` is the gallery's
+    student_key per row) is given to at most one face in the photo.
+    Returns a list of (gallery_row, distance) or None per face.
+    """
+    n_faces = cand_dist.shape[0]
+    assigned = [None] * n_faces
+    faces, cols = np.nonzero(cand_dist <= tolerance)
+    if faces.size == 0:
+        return assigned
+    order = np.argsort(cand_dist[faces, cols], kind="stable")
+    taken = set()
+    for f, c in zip(faces[order], cols[order]):
+        if assigned[f] is not None:
+            continue
+        row = int(cand_idx[f, c])
+        key = keys[row]
+        if key in taken:
+            continue
+        assigned[f] = (row, float(cand_dist[f, c]))
+        taken.add(key)
+    return assigned
+
+def analyse_image(image, model='hog', tiled=None):
+    # detect on a downscaled copy, encode from full-resolution pixels;
+    # very large photos are split into tiles across the worker pool
+    if detection.use_tiling(image, tiled):
+        return detection.detect_and_encode_tiled(image, model=model)
+    return detection.detect_and_encode(image, model=model)
+
+def match_faces(gallery, face_locations, face_encodings, tolerance=0.45, image=None):
+    """Match detected faces against one gallery snapshot.
+
+    Unrecognised faces are cropped and logged only when the decoded `image`
+    is given (it is not when results are rebuilt from the upload cache).
+    """
     results = []
-    if KNOWN_ENCODINGS.size == 0:
+    if gallery.size == 0:
         for loc in face_locations:
-            results.append({"name": None, "distance": None, "location": loc})
+            results.append({"name": None, "student_id": None, "distance": None, "location": loc})
+        return results
+    if not len(face_locations):
         return results
 
-    for loc, enc in zip(face_locations, face_encodings):
-        distances = face_recognition.face_distance(KNOWN_ENCODINGS, enc)
-        best_idx = int(np.argmin(distances))
-        best_dist = float(distances[best_idx])
-        if best_dist <= tolerance:
-            name = KNOWN_NAMES[best_idx]
+    gallery_rows_searched.observe(gallery.size)
+    with span("match"):
+        cand_dist, cand_idx = gallery.index.search(face_encodings, MATCH_CANDIDATES)
+        assigned = assign_matches(cand_dist, cand_idx, gallery.keys, tolerance)
+
+    for i, loc in enumerate(face_locations):
+        match = assigned[i]
+        if match is not None:
+            row, best_dist = match
+            name, student_id = gallery.names[row], gallery.ids[row]
         else:
-            name = None
+            name = student_id = None
+            best_dist = float(cand_dist[i, 0])
 
+        if match is None and best_dist > tolerance and image is not None:
             # --- LOG UNKNOWN FACE ---
-            # save unknown face image
+            # crop is saved and logged to the database by the background writer
             top, right, bottom, left = loc
-            unknown_face_img = image[top:bottom, left:right]
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            filename = f"unknown_{timestamp}.jpg"
-            save_path = os.path.join(UNKNOWN_FACES_DIR, filename)
-            cv2.imwrite(save_path, cv2.cvtColor(unknown_face_img, cv2.COLOR_RGB2BGR))
-
-            # log to database
-            log_unknown_face(filename, "Face not recognized")
+            with span("unknown_submit"):
+                unknown_faces.writer.submit(image[top:bottom, left:right], "Face not recognized",
+                                            encoding=face_encodings[i])
             # -----------------------
 
-        results.append({"name": name, "distance": best_dist, "location": loc})
+        results.append({"name": name, "student_id": student_id, "distance": best_dist, "location": loc})
     return results
 
+def match_faces_scoped(gallery, partition, face_locations, face_encodings, tolerance=0.45, fallback=True,
+                       image=None):
+    """match_faces() against a class partition, retrying its misses on the full gallery.
+
+    With `fallback`, faces the partition can't place (students visiting from
+    another section) are matched against the whole gallery and flagged
+    "visiting"; only faces unknown to both are logged as unknown.
+    """
+    if partition is gallery:
+        return match_faces(gallery, face_locations, face_encodings, tolerance, image=image)
+    results = match_faces(partition, face_locations, face_encodings, tolerance, image=None if fallback else image)
+    for r in results:
+        r["visiting"] = False
+    misses = [i for i, r in enumerate(results) if r["name"] is None]
+    if not fallback or not misses or gallery.size == 0:
+        return results
+
+    encodings = np.asarray(face_encodings, dtype=np.float32).reshape(-1, encodings_store.ENCODING_DIM)
+    retry = match_faces(gallery, [face_locations[i] for i in misses], encodings[misses], tolerance, image=image)
+    taken = {student_key(r["student_id"], r["name"]) for r in results if r["name"] is not None}
+    for i, r in zip(misses, retry):
+        if r["name"] is not None and student_key(r["student_id"], r["name"]) not in taken:
+            results[i] = dict(r, visiting=True)
+    return results
+
+def recognize_faces_in_image(image_path, tolerance=0.45, model='hog', tiled=None,
+                             branch=None, section=None, year=None, fallback=True):
+    gallery = get_gallery()  # pinned for the whole request
+    with span("partition"):
+        partition = get_partition(gallery, branch, section, year)
+    with span("decode"):
+        image = face_recognition.load_image_file(image_path)
+    face_locations, face_encodings = analyse_image(image, model=model, tiled=tiled)
+    faces_per_image.observe(len(face_locations))
+    return match_faces_scoped(gallery, partition, face_locations, face_encodings, tolerance, fallback, image=image)
+
+def recognize_faces_in_upload(data, save_path, tolerance=0.45, model='hog', tiled=None,
+                              branch=None, section=None, year=None, fallback=True):
+    """recognize_faces_in_image() for raw upload bytes, fronted by the upload cache.
+
+    A repeated upload (same bytes, model and tiling) skips the save, decode,
+    detection and encoding; only the gallery match is redone if the gallery
+    (or partition) version or tolerance changed since the cached run.
+    Returns (results, cache_status).
+    """
+    gallery = get_gallery()
+    with span("partition"):
+        partition = get_partition(gallery, branch, section, year)
+    with span("hash"):
+        key = (result_cache.content_key(data), model, tiled)
+    match_key = (partition.version, gallery.version if fallback else None, tolerance)
+    entry = result_cache.upload_cache.get(key)
+    if entry is not None:
+        if entry.match_key != match_key:
+            results = match_faces_scoped(gallery, partition, entry.locations, entry.encodings, tolerance,
+                                         fallback)
+            result_cache.upload_cache.put(key, entry.rematched(match_key, results))
+            return [dict(r) for r in results], "rematched"
+        return [dict(r) for r in entry.results], "hit"
+
+    with span("save"), open(save_path, "wb") as f:
+        f.write(data)
+    with span("decode"):
+        image = face_recognition.load_image_file(save_path)
+    face_locations, face_encodings = analyse_image(image, model=model, tiled=tiled)
+    faces_per_image.observe(len(face_locations))
+    results = match_faces_scoped(gallery, partition, face_locations, face_encodings, tolerance, fallback,
+                                 image=image)
+
+    entry = result_cache.CacheEntry(list(face_locations),
+                                    np.asarray(face_encodings, dtype=np.float32).reshape(-1, encodings_store.ENCODING_DIM),
+                                    match_key, results)
+    result_cache.upload_cache.put(key, entry)
+    return [dict(r) for r in results], "miss"
+
+def merge_results(per_photo):
+    """Fold several photos of one room into a single roll call.
+
+    `per_photo` is a list of recognize_faces_in_image() results. A student
+    seen in more than one photo is reported once, with the best (lowest)
+    distance and the photo it came from; unrecognised faces are kept per photo.
+    """
+    students = {}
+    unknown = []
+    for photo_idx, results in enumerate(per_photo):
+        for r in results or []:
+            if r["name"] is None:
+                unknown.append({"photo": photo_idx, "distance": r["distance"], "location": r["location"]})
+                continue
+            key = student_key(r.get("student_id"), r["name"])  # two students may share a name
+            best = students.get(key)
+            if best is None:
+                students[key] = best = {"name": r["name"], "student_id": r.get("student_id"),
+                                              "distance": r["distance"], "photo": photo_idx,
+                                              "location": r["location"], "seen_in": []}
+            elif r["distance"] < best["distance"]:
+                best.update(distance=r["distance"], photo=photo_idx, location=r["location"])
+            if photo_idx not in best["seen_in"]:
+                best["seen_in"].append(photo_idx)
+    return {"students": sorted(students.values(), key=lambda s: str(s["name"])), "unknown": unknown}
+
 # # recognition.py
 # import os
 # import pickle
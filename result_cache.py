@@ -0,0 +1,83 @@
+# result_cache.py
+# Bounded LRU cache of detection results, keyed by image content hash and
+# the detection settings (model, tiling).
+#
+# Detection and encoding only depend on the pixels and those settings, so
+# they are kept for as long as the entry survives; the matched results
+# additionally depend on the gallery version and tolerance and are redone
+# (cheaply, from the cached encodings) whenever either changes.
+#
+# Entries are never modified once cached: a rematch caches a new entry
+# (rematched()) under the same key, so concurrent requests always read a
+# consistent match_key/results pair.
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+CACHE_BYTES = int(float(os.getenv("RESULT_CACHE_MB", "64")) * 1024 * 1024)
+CACHE_ENTRIES = int(os.getenv("RESULT_CACHE_ENTRIES", "512"))
+
+
+def content_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class CacheEntry:
+    __slots__ = ("locations", "encodings", "nbytes", "match_key", "results")
+
+    def __init__(self, locations, encodings, match_key=None, results=None):
+        self.locations = locations
+        self.encodings = encodings
+        # encodings dominate; locations and results are small tuples/dicts
+        self.nbytes = int(getattr(encodings, "nbytes", 0)) + 64 * (len(locations) + 1)
+        self.match_key = match_key
+        self.results = results
+
+    def rematched(self, match_key, results):
+        """A copy sharing this entry's detections, with new match results."""
+        return CacheEntry(self.locations, self.encodings, match_key, results)
+
+
+class ResultCache:
+    def __init__(self, max_bytes=CACHE_BYTES, max_entries=CACHE_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        if entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[key] = entry
+            self._bytes += entry.nbytes
+            while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_entries):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+upload_cache = ResultCache()
@@ -0,0 +1,50 @@
+# roll_call.py
+# Recognition results -> attendance for one class in one pass.
+#
+# Matches are mapped to student_ids through the in-memory roster, present and
+# absent are set operations against the class's enrolled ids, and both are
+# written with a single save_attendance_bulk() transaction. A roll call only
+# ever adds sightings: students already marked Present for the day stay
+# Present even if this run did not see them.
+import numpy as np
+from db import save_attendance_bulk
+from recognition import merge_results
+from roster import roster
+
+
+def take_roll_call(per_photo, recorded_by, branch=None, section=None, year=None, date=None, dry_run=False):
+    """Mark a class from the recognition results of one or more photos.
+
+    `per_photo` is a list of recognize_faces_in_image() results. Students of
+    other classes who were recognised are reported as `outside_class` and not
+    written. Returns the summary dict; `saved` is None if the write failed.
+    """
+    snapshot = roster.get()
+    enrolled = snapshot.class_ids(branch=branch, section=section, year=year)
+    merged = merge_results(per_photo)
+    matched, unresolved = snapshot.resolve(merged["students"])
+
+    present = np.intersect1d(enrolled, matched, assume_unique=True)
+    absent = np.setdiff1d(enrolled, present, assume_unique=True)
+    outside = np.setdiff1d(matched, enrolled, assume_unique=True)
+
+    summary = {
+        "class": {"branch": branch, "section": section, "year": year},
+        "date": date,
+        "enrolled_count": int(enrolled.size),
+        "present_count": int(present.size),
+        "absent_count": int(absent.size),
+        "present": snapshot.describe(present),
+        "absent": snapshot.describe(absent),
+        "outside_class": snapshot.describe(outside),
+        "unresolved": unresolved,
+        "unknown_count": len(merged["unknown"]),
+        "saved": 0,
+    }
+    if dry_run or not enrolled.size:
+        return summary
+
+    statuses = dict.fromkeys(present.tolist(), True)
+    statuses.update(dict.fromkeys(absent.tolist(), False))
+    summary["saved"] = save_attendance_bulk(statuses, recorded_by, date=date, keep_present=True)
+    return summary
@@ -0,0 +1,159 @@
+# roster.py
+# In-memory copy of the students table for roll calls and /students.
+#
+# The roster is read once and kept as numpy columns so a class lookup is a
+# boolean mask and present/absent is a set difference, not a query per
+# student. It is refreshed when db.notify_change("students") fires in this
+# process, and at most ROSTER_TTL_SECONDS later for writes made elsewhere.
+#
+# Callers that must not serve stale rows (/students) pass the table's
+# stamp() - row count and MAX(updated_at) (migrations/0004) - to get(), which
+# reloads whenever the stamp moved. The same stamp is the ETag, so every
+# server process hands out and accepts the same tags.
+import os
+import time
+import threading
+import numpy as np
+from db import get_connection, add_change_listener, Error
+
+ROSTER_TTL_SECONDS = float(os.getenv("ROSTER_TTL_SECONDS", "300"))
+ER_BAD_FIELD_ERROR = 1054  # students.updated_at missing: migrations/0004 not applied
+
+
+def _norm(value):
+    # branch/section are free text from the admin form; year is an int column
+    return "" if value is None else str(value).strip().lower()
+
+
+def class_key(branch=None, section=None, year=None):
+    return _norm(branch), _norm(section), _norm(year)
+
+
+class RosterSnapshot:
+    """Immutable view of the students table; swapped whole on refresh."""
+
+    def __init__(self, rows, version):
+        self.version = version
+        self.rows = rows
+        self.student_ids = np.array([r["student_id"] for r in rows], dtype=np.int64)
+        self.branches = np.array([_norm(r["branch"]) for r in rows], dtype=object)
+        self.sections = np.array([_norm(r["section"]) for r in rows], dtype=object)
+        self.years = np.array([_norm(r["year"]) for r in rows], dtype=object)
+        self.by_id = {r["student_id"]: r for r in rows}
+        # names are not unique; only unambiguous ones can be resolved by name
+        by_name = {}
+        for r in rows:
+            by_name.setdefault(r["name"], []).append(r["student_id"])
+        self.id_by_name = {name: ids[0] for name, ids in by_name.items() if len(ids) == 1}
+
+    def class_ids(self, branch=None, section=None, year=None):
+        """Sorted student_ids of a class; filters left as None match everyone."""
+        mask = np.ones(len(self.student_ids), dtype=bool)
+        for column, value in zip((self.branches, self.sections, self.years), class_key(branch, section, year)):
+            if value:
+                mask &= column == value
+        return np.unique(self.student_ids[mask])
+
+    def resolve(self, matches):
+        """student_ids for recognised faces (dicts with student_id and/or name).
+
+        Returns (ids, unresolved names). Gallery rows carry the student_id;
+        the name is only used for rows built without one.
+        """
+        ids, unresolved = [], []
+        for m in matches:
+            student_id = m.get("student_id")
+            if student_id is None:
+                student_id = self.id_by_name.get(m.get("name"))
+            if student_id is None or int(student_id) not in self.by_id:
+                unresolved.append(m.get("name"))
+                continue
+            ids.append(int(student_id))
+        return np.unique(np.array(ids, dtype=np.int64)), unresolved
+
+    def describe(self, student_ids):
+        return [{k: self.by_id[int(i)][k] for k in ("student_id", "name", "roll_no")} for i in student_ids]
+
+    def page(self, after=None, limit=100, branch=None, section=None, year=None):
+        """Keyset page of students ordered by student_id.
+
+        Returns (rows, next_after); next_after is None on the last page.
+        """
+        ids = self.class_ids(branch, section, year)
+        start = int(np.searchsorted(ids, after, side="right")) if after is not None else 0
+        chunk = ids[start:start + limit]
+        next_after = int(chunk[-1]) if start + limit < len(ids) else None
+        return [self.by_id[int(i)] for i in chunk], next_after
+
+
+class Roster:
+    def __init__(self, ttl=ROSTER_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._stamp = None
+        self._snapshot = RosterSnapshot([], 0)
+
+    def invalidate(self, *_):
+        with self._lock:
+            self._loaded_at = None
+
+    def stamp(self):
+        """(row count, latest updated_at) of the students table, or None
+        without migrations/0004. Cheap: both come from indexes."""
+        conn = get_connection()
+        if conn is None:
+            raise RuntimeError("Database connection failed")
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT COUNT(*), MAX(updated_at) FROM students")
+            count, updated = cursor.fetchone()
+            return int(count), updated
+        except Error as e:
+            if e.errno != ER_BAD_FIELD_ERROR:
+                raise
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _load(self, stamp=None):
+        conn = get_connection()
+        if conn is None:
+            raise RuntimeError("Database connection failed")
+        try:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute("""SELECT student_id, name, roll_no, branch, section, year, passout_year
+                              FROM students ORDER BY student_id""")
+            rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            conn.close()
+        self._loaded_at = time.time()
+        self._stamp = stamp
+        if rows == self._snapshot.rows and self._snapshot.version:
+            return  # nothing changed: keep the version (and every cache keyed on it)
+        self._snapshot = RosterSnapshot(rows, self._snapshot.version + 1)
+
+    def get(self, stamp=None):
+        """Current snapshot, reloading it first if it was invalidated, is
+        stale, or was loaded at a different stamp() than the one given."""
+        with self._lock:
+            if self._loaded_at is None or time.time() - self._loaded_at > self.ttl \
+                    or (stamp is not None and stamp != self._stamp):
+                # the stamp is read before the rows: a write in between only
+                # makes the next request reload once more, never serve old rows
+                self._load(stamp)
+            return self._snapshot
+
+
+def etag(stamp):
+    """Entity tag for a stamp(); None (no caching) without one."""
+    if stamp is None:
+        return None
+    count, updated = stamp
+    return f"{count}.{updated.strftime('%Y%m%d%H%M%S%f') if updated else 0}"
+
+
+roster = Roster()
+add_change_listener("students", roster.invalidate)
@@ -1,13 +1,23 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import os, subprocess, sys
-import io
-import pickle, face_recognition
-import pandas as pd
+import time
+from concurrent.futures.process import BrokenProcessPool
+import encoding_builder
 from werkzeug.utils import secure_filename
-from recognition import recognize_faces_in_image, reload_encodings
-from db import save_student, save_attendance, get_connection  # ✅ DB functions
-from attendance_export import export_attendance_to_excel
+from recognition import recognize_faces_in_upload, reload_encodings, start_gallery_watcher, merge_results, get_gallery
+from db import (save_student, save_attendance, save_attendance_bulk, get_connection, notify_change,
+                refresh_daily_summary, pool_stats, DB_CONFIG)  # ✅ DB functions
+from attendance_export import parse_filters, stream_attendance
+from unknown_clusters import clusters as unknown_clusters
+from roll_call import take_roll_call
+from roster import roster, etag as roster_etag
+from admin_stats import stats as admin_stats_cache
+import log_reader
+import metrics
+import result_cache
+from unknown_faces import writer as unknown_writer
+from jobs import recognition_jobs, QueueFull, BATCH_TIMEOUT_SECONDS, run_video_job, upload_path, discard_upload
 from datetime import datetime
 
 app = Flask(__name__)
@@ -18,6 +28,54 @@ CORS(app, resources={r"/*": {"origins": ["http://localhost:3000", "http://127.0.
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Pick up encodings rebuilt by any process without a restart
+start_gallery_watcher()
+
+# ==========================
+# Metrics
+# ==========================
+# Request latency per route plus gauges read at scrape time; stage timings
+# come from the spans in detection/recognition/db (see metrics.py)
+http_request_seconds = metrics.histogram("attendance_http_request_seconds", "HTTP request latency",
+                                         labelnames=("endpoint", "method", "status"))
+UNTIMED_ENDPOINTS = {"stream_system_logs"}  # server-sent events: open for as long as the client listens
+metrics.gauge("attendance_gallery_size", "Encodings in the loaded gallery", lambda: get_gallery().size)
+metrics.gauge("attendance_gallery_version", "Version of the loaded gallery", lambda: get_gallery().version)
+metrics.gauge("attendance_db_pool_connections", "Database pool connections by state",
+              lambda: {k: v for k, v in pool_stats().items() if k in ("in_use", "idle", "size")}, "state")
+metrics.gauge("attendance_job_queue_depth_current", "Recognition jobs queued or running", recognition_jobs.depth)
+metrics.gauge("attendance_unknown_writer_queue_depth", "Unknown-face writes waiting to be flushed",
+              unknown_writer.depth)
+metrics.gauge("attendance_upload_cache", "Upload result cache usage",
+              lambda: {k: v for k, v in result_cache.upload_cache.stats().items() if k in ("entries", "bytes")},
+              "kind")
+
+
+@app.before_request
+def _start_timer():
+    request._metrics_started = time.perf_counter()
+
+
+@app.after_request
+def _observe_request(response):
+    started = getattr(request, "_metrics_started", None)
+    if started is None or request.endpoint in UNTIMED_ENDPOINTS:
+        return response
+    labels = dict(endpoint=request.endpoint or "unmatched", method=request.method, status=response.status_code)
+    observe = lambda: http_request_seconds.observe(time.perf_counter() - started, **labels)
+    if response.is_streamed:
+        # a streamed body (the exports) is still being generated here; time it to the last byte
+        response.call_on_close(observe)
+    else:
+        observe()
+    return response
+
+
+@app.route('/metrics')
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 # ==========================
 # Role check
 # ==========================
@@ -60,28 +118,33 @@ def rebuild_encodings_route():
 
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT name, photo_path FROM students WHERE photo_path IS NOT NULL")
+    cursor.execute("SELECT student_id, name, photo_path FROM students")
     students = cursor.fetchall()
     cursor.close()
     conn.close()
 
-    encodings = []
-    names = []
-
+    photos = []
     for student in students:
-        name, photo_path = student
-        if os.path.exists(photo_path):
-            image = face_recognition.load_image_file(photo_path)
-            face_enc = face_recognition.face_encodings(image)
-            if face_enc:
-                encodings.append(face_enc[0])
-                names.append(name)
-
-    # Save encodings
-    with open("encodings.pickle", "wb") as f:
-        pickle.dump({"encodings": encodings, "names": names}, f)
+        student_id, name, photo_path = student
+        if photo_path and os.path.exists(photo_path):
+            photos.append({"path": photo_path, "name": name, "id": student_id})
 
-    return jsonify({"message": "Encodings rebuilt", "count": len(names)})
+    # Incremental: only photos added/changed since the last build are encoded
+    # (?workers=N is capped at ENCODE_WORKERS by the builder)
+    try:
+        report = encoding_builder.rebuild(photos, first_only=True, full=request.args.get("full") == "1",
+                                          workers=request.args.get("workers", type=int),
+                                          student_ids={student[0] for student in students})
+    except BrokenProcessPool as e:
+        return jsonify({"error": f"encoding workers died: {e or 'process pool broken'}"}), 503
+    if report["written"]:
+        reload_encodings()
+
+    return jsonify({"message": "Encodings rebuilt", "count": report["rows"], "version": report.get("version"),
+                    "added": report["added"], "changed": report["changed"], "removed": report["removed"],
+                    "unchanged": report["unchanged"], "failed": report["failed"],
+                    "photos_per_sec": report["photos_per_sec"],
+                    "index": report.get("index"), "seconds": report["seconds"]})
 
 UPLOAD_FOLDER = "uploads/unknown_faces"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)  # make sure folder exists
@@ -168,13 +231,19 @@ def update_student(roll_no):
         return jsonify({"error": "Database connection failed"}), 500
     try:
         cursor = conn.cursor()
+        cursor.execute("SELECT section FROM students WHERE roll_no = %s", (roll_no,))
+        old = cursor.fetchone()
         cursor.execute("""
             UPDATE students
             SET name = %s, branch = %s, section = %s, year = %s, passout_year = %s
             WHERE roll_no = %s
         """, (new_name, new_branch, new_section, new_year, new_passout_year, roll_no))
+        updated = cursor.rowcount
+        if old and (old[0] or "") != (new_section or ""):
+            refresh_daily_summary(cursor, sections=[old[0], new_section])
         conn.commit()
-        if cursor.rowcount == 0:
+        notify_change("students")
+        if updated == 0:
             return jsonify({"error": "Student not found"}), 404
         return jsonify({"message": "Student updated successfully"}), 200
     except Exception as e:
@@ -185,26 +254,22 @@ def update_student(roll_no):
 
 @app.route('/admin-stats')
 def admin_stats():
-    # Query total students and total attendance from DB
-    conn = get_connection()
-    if not conn:
-        return jsonify({"error": "DB connection failed"}), 500
+    # Counters come from the in-process stats cache (admin_stats.py): they are
+    # recounted only after a write or once the TTL runs out
     try:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT COUNT(*) as totalStudents FROM students")
-        total_students = cursor.fetchone()["totalStudents"]
-        cursor.execute("SELECT COUNT(*) as totalAttendance FROM attendance")
-        total_attendance = cursor.fetchone()["totalAttendance"]
-    finally:
-        cursor.close()
-        conn.close()
-    return jsonify({
-        "totalStudents": total_students,
-        "attendanceRecords": total_attendance,
-        "lastBackup": "Not implemented",
+        counts = admin_stats_cache.snapshot()
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 500
+    gallery = get_gallery()
+    return jsonify(dict(counts, **{
+        "gallerySize": gallery.size,
+        "galleryVersion": gallery.version,
         "systemHealth": "Good"
-    })
+    }))
+
 
+REPORT_PAGE_SIZE = 100
+REPORT_MAX_PAGE_SIZE = 1000
 
 @app.route('/attendance-report', methods=['GET'])
 def attendance_report_route():
@@ -212,119 +277,100 @@ def attendance_report_route():
     if get_role() != "admin":
         return jsonify({"error": "unauthorized"}), 403
 
+    # Reads the per-section daily summary only (see db.refresh_daily_summary).
+    # ?date_from=&date_to=YYYY-MM-DD, ?section=, ?page= (from 1), ?limit=
+    try:
+        filters = parse_filters(request.args)
+    except ValueError:
+        return jsonify({"error": "dates must be YYYY-MM-DD"}), 400
+    page = max(1, request.args.get("page", 1, type=int))
+    limit = min(max(1, request.args.get("limit", REPORT_PAGE_SIZE, type=int)), REPORT_MAX_PAGE_SIZE)
+
+    where, args = [], []
+    if "date_from" in filters:
+        where.append("date >= %s")
+        args.append(filters["date_from"])
+    if "date_to" in filters:
+        where.append("date <= %s")
+        args.append(filters["date_to"])
+    if "section" in filters:
+        where.append("section = %s")
+        args.append(filters["section"])
+    clause = ("WHERE " + " AND ".join(where)) if where else ""
+
     conn = get_connection()
     if conn is None:
         return jsonify({"error": "DB connection failed"}), 500
 
     try:
         cursor = conn.cursor(dictionary=True)
-
-        # Aggregate attendance per class per date
-        cursor.execute("""
-            SELECT 
-                s.section AS class,
-                a.date,
-                SUM(CASE WHEN a.status='present' THEN 1 ELSE 0 END) AS present,
-                SUM(CASE WHEN a.status='absent' THEN 1 ELSE 0 END) AS absent,
-                COUNT(*) AS total,
-                ROUND(SUM(CASE WHEN a.status='present' THEN 1 ELSE 0 END) / COUNT(*) * 100, 2) AS percentage
-            FROM attendance a
-            JOIN students s ON a.student_id = s.student_id
-            GROUP BY class, a.date
-            ORDER BY a.date DESC, class ASC
-        """)
+        cursor.execute(f"SELECT COUNT(*) AS total FROM attendance_daily_summary {clause}", args)
+        total_rows = cursor.fetchone()["total"]
+        cursor.execute(f"""
+            SELECT
+                section AS class,
+                date,
+                present,
+                absent,
+                present + absent AS total,
+                ROUND(present / NULLIF(present + absent, 0) * 100, 2) AS percentage
+            FROM attendance_daily_summary
+            {clause}
+            ORDER BY date DESC, section ASC
+            LIMIT %s OFFSET %s
+        """, args + [limit, (page - 1) * limit])
 
         rows = cursor.fetchall()
 
         # Convert datetime.date to string for JSON
         for row in rows:
-            if isinstance(row['date'], (datetime, )):
-                row['date'] = row['date'].strftime('%Y-%m-%d')
+            row['date'] = row['date'].strftime('%Y-%m-%d')
+            row['percentage'] = float(row['percentage'] or 0)
 
-        return jsonify({"attendance": rows})
+        return jsonify({"attendance": rows, "page": page, "limit": limit, "total": total_rows,
+                        "has_more": page * limit < total_rows})
 
     finally:
         cursor.close()
         conn.close()
 
+def _stream_export(columns, basename):
+    # ?format=csv|xlsx (default xlsx), ?date_from=&date_to=YYYY-MM-DD, ?branch=&section=
+    try:
+        filters = parse_filters(request.args)
+    except ValueError:
+        return jsonify({"error": "dates must be YYYY-MM-DD"}), 400
+    fmt = request.args.get("format", "xlsx").lower()
+    if fmt not in ("csv", "xlsx"):
+        return jsonify({"error": "format must be csv or xlsx"}), 400
+    try:
+        body, mimetype, ext = stream_attendance(fmt, columns=columns, filters=filters)
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 500
+
+    filename = f"{basename}.{ext}"
+    return Response(body, mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"',
+                             "X-Accel-Buffering": "no"})
+
 @app.route('/export-attendance', methods=['GET'])
 def export_attendance_route():
     if get_role() != "admin":
         return jsonify({"error": "unauthorized"}), 403
 
-    conn = get_connection()
-    if not conn:
-        return jsonify({"error": "DB connection failed"}), 500
-
-    try:
-        cursor = conn.cursor(dictionary=True)
-        # Fetch all raw attendance records
-        cursor.execute("""
-            SELECT 
-                s.name,
-                s.roll_no AS studentId,
-                s.section AS class,
-                a.date,
-                a.status
-            FROM attendance a
-            JOIN students s ON a.student_id = s.student_id
-            ORDER BY a.date DESC, class ASC
-        """)
-        rows = cursor.fetchall()
-
-        # Export to Excel using pandas
-        df = pd.DataFrame(rows)
-        output = io.BytesIO()
-        df.to_excel(output, index=False)
-        output.seek(0)
-
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"attendance_export_{timestamp}.xlsx"
-
-        return send_file(
-            output,
-            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            as_attachment=True,
-            download_name=filename
-        )
-    finally:
-        cursor.close()
-        conn.close()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return _stream_export([("s.name", "name"), ("s.roll_no", "studentId"), ("s.section", "class"),
+                           ("a.date", "date"), ("a.status", "status")],
+                          f"attendance_export_{timestamp}")
 
 @app.route('/export-attendance-archive', methods=['GET'])
 def export_attendance():
     if get_role() != "admin":
         return jsonify({"error": "unauthorized"}), 403
 
-    conn = get_connection()
-    if conn is None:
-        return jsonify({"error": "DB connection failed"}), 500
-    
-    try:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT s.name, s.roll_no, s.branch, s.section, a.date, a.status
-            FROM attendance a
-            JOIN students s ON a.student_id = s.student_id
-        """)
-        rows = cursor.fetchall()
-
-        import pandas as pd
-        import io
-        from flask import send_file
-
-        df = pd.DataFrame(rows)
-        output = io.BytesIO()
-        df.to_excel(output, index=False)
-        output.seek(0)
-
-        return send_file(output,
-                         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                         as_attachment=True,
-                         download_name="attendance_export.xlsx")
-    finally:
-        cursor.close()
-        conn.close()
+    return _stream_export([("s.name", "name"), ("s.roll_no", "roll_no"), ("s.branch", "branch"),
+                           ("s.section", "section"), ("a.date", "date"), ("a.status", "status")],
+                          "attendance_export")
 
 
 @app.route('/backup-database', methods=['POST'])
@@ -333,9 +379,24 @@ def backup_database():
         return jsonify({"error": "unauthorized"}), 403
     # Example using mysqldump
     filename = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.sql"
-    cmd = f"mysqldump -u root -pvrinda487 smartattendance > backups/{filename}"
     os.makedirs("backups", exist_ok=True)
-    subprocess.run(cmd, shell=True)
+    # same credentials as the connection pool; password via env, not argv
+    cmd = ["mysqldump", "-h", DB_CONFIG["host"], "-P", str(DB_CONFIG["port"]), "-u", DB_CONFIG["user"],
+           DB_CONFIG["database"]]
+    path = os.path.join("backups", filename)
+    try:
+        with open(path, "w") as out:
+            p = subprocess.run(cmd, stdout=out, stderr=subprocess.PIPE, text=True,
+                               env=dict(os.environ, MYSQL_PWD=DB_CONFIG["password"]))
+        error = p.stderr.strip() if p.returncode != 0 else None
+    except OSError as e:  # mysqldump missing, disk full
+        error = str(e)
+    if error is not None:
+        # a partial dump must not be listed (or restored) as a backup
+        if os.path.exists(path):
+            os.remove(path)
+        return jsonify({"error": f"backup failed: {error or 'mysqldump exited with an error'}"}), 500
+    notify_change("backups")
     return jsonify({"status": "success", "filename": filename, "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
 
 @app.route('/rebuild-encodings', methods=['POST'])
@@ -358,69 +419,111 @@ def system_logs():
     if get_role() != "admin":
         return jsonify({"error": "unauthorized"}), 403
 
-    logs = []
+    # Latest ?limit= lines by default; ?before=<offset> pages back through
+    # older lines, ?after=<offset> returns only lines written since
+    limit = min(max(1, request.args.get("limit", log_reader.DEFAULT_LIMIT, type=int)), log_reader.MAX_LIMIT)
+    after = request.args.get("after", type=int)
     try:
-        # Check if log file exists
-        if os.path.exists("system.log"):
-            with open("system.log", "r") as f:
-                for i, line in enumerate(f.readlines()):
-                    # Each log is an object with keys used by frontend
-                    logs.append({
-                        "log_id": i,
-                        "log_time": datetime.now().isoformat(),  # or parse timestamp if in file
-                        "log_type": "info",  # default type, can extend later
-                        "category": "system",  # default category
-                        "message": line.strip()
-                    })
-        # Return as JSON object
-        return jsonify({"logs": logs})
+        if after is not None:
+            logs, next_after = log_reader.read_after(log_reader.LOG_FILE, after, limit)
+            return jsonify({"logs": logs, "next_after": next_after})
+        logs, before, size = log_reader.read_before(log_reader.LOG_FILE, request.args.get("before", type=int), limit)
+        return jsonify({"logs": logs, "before": before, "next_after": size})
     except Exception as e:
         # In case of any error, still return JSON
         return jsonify({"logs": [], "error": str(e)}), 500
 
+@app.route("/db-logs", methods=['GET'])
+def db_logs():
+    # `logs` table (UnknownFace / Error / System), newest first:
+    # ?type=UnknownFace&before=<log_id of the last row seen>&limit=N
+    if get_role() != "admin":
+        return jsonify({"error": "unauthorized"}), 403
+
+    limit = min(max(1, request.args.get("limit", log_reader.DEFAULT_LIMIT, type=int)), log_reader.MAX_LIMIT)
+    try:
+        rows = log_reader.page_db_logs(log_type=request.args.get("type"),
+                                       before_id=request.args.get("before", type=int), limit=limit)
+    except RuntimeError as e:
+        return jsonify({"logs": [], "error": str(e)}), 500
+    return jsonify({"logs": rows, "before": rows[-1]["log_id"] if len(rows) == limit else None})
+
+@app.route("/system-logs/stream", methods=['GET'])
+def stream_system_logs():
+    # Server-sent events: "system" for new system.log lines, "database" for
+    # new `logs` rows. Reconnects resume from Last-Event-ID.
+    # EventSource can't set headers, so the role may also come as ?role=
+    if (get_role() or request.args.get("role", "").lower()) != "admin":
+        return jsonify({"error": "unauthorized"}), 403
+
+    offset, db_after = log_reader.parse_event_id(request.headers.get("Last-Event-ID"))
+    if offset is None:
+        offset = request.args.get("after", type=int)
+        db_after = request.args.get("db_after", type=int)
+    events = log_reader.stream_events(log_reader.LOG_FILE, offset=offset, db_after=db_after,
+                                      log_type=request.args.get("type"))
+    return Response(events, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 
 
 
 
+STUDENTS_PAGE_SIZE = 200
+STUDENTS_MAX_PAGE_SIZE = 1000
 
 @app.route('/students', methods=['GET'])
 def get_students_route():
+    # Served from the in-memory roster. Without ?after or ?limit it is the
+    # whole list, as before; with either, a keyset page:
+    # ?after=<last id of the previous page>&limit=N&branch=&section=&year=
+    # The ETag is the students table's change stamp (see roster.py), the same
+    # in every server process, so an unchanged list is a 304.
     try:
         if get_role() != "admin":
             return jsonify({"error": "unauthorized"}), 403
 
-        conn = get_connection()
-        if not conn:
-            return jsonify({"error": "Database connection failed"}), 500
-
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT student_id AS id,
-                   name,
-                   roll_no,
-                   branch,
-                   section,
-                   year,
-                   passout_year,
-                   'active' AS status,
-                   'pending' AS encoding_status,
-                   NULL AS last_seen
-            FROM students
-        """)
-        rows = cursor.fetchall()
-        return jsonify({"students": rows}), 200
+        stamp = roster.stamp()
+        etag = roster_etag(stamp)
+        if etag and request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        snapshot = roster.get(stamp)
+
+        filters = {k: request.args.get(k) for k in ("branch", "section", "year")}
+        paged = "after" in request.args or "limit" in request.args
+        if paged:
+            limit = min(max(1, request.args.get("limit", STUDENTS_PAGE_SIZE, type=int)), STUDENTS_MAX_PAGE_SIZE)
+            rows, next_after = snapshot.page(after=request.args.get("after", type=int), limit=limit, **filters)
+        else:
+            rows = [snapshot.by_id[int(i)] for i in snapshot.class_ids(**filters)]
+        students = [{
+            "id": r["student_id"],
+            "name": r["name"],
+            "roll_no": r["roll_no"],
+            "branch": r["branch"],
+            "section": r["section"],
+            "year": r["year"],
+            "passout_year": r["passout_year"],
+            "status": "active",
+            "encoding_status": "pending",
+            "last_seen": None,
+        } for r in rows]
+        body = {"students": students}
+        if paged:
+            body.update(next_after=next_after, limit=limit)
+        response = jsonify(body)
+        if etag:
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"  # always revalidate
+        return response, 200
 
     except Exception as e:
         print("❌ Error in /students:", e)
         return jsonify({"error": str(e)}), 500
 
-    finally:
-        try:
-            cursor.close()
-            conn.close()
-        except:
-            pass
-
 
 
 @app.route('/upload-photo/<user_id>', methods=['POST'])
@@ -433,12 +536,29 @@ def upload_photo(user_id):
 
     f = request.files['image']
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)  # ✅ ensure folder exists
+    async_mode = request.args.get("async") == "1"
+    tiled = request.args.get("tiled")
+    options = {"tiled": None if tiled is None else tiled == "1"}
+    options.update(_scope_options(request.args))
+
+    if async_mode:
+        # queued uploads need a unique name until their job has run; the job deletes it
+        save_path = upload_path(secure_filename(f.filename))
+        f.save(save_path)
+        try:
+            job = recognition_jobs.submit(save_path, options, upload=save_path, user_id=user_id)
+        except (QueueFull, BrokenProcessPool) as e:
+            discard_upload(save_path)
+            return jsonify({"error": str(e)}), 503
+        job["poll"] = f"/jobs/{job['job_id']}"
+        return jsonify(job), 202
+
     save_path = os.path.join(UPLOAD_FOLDER, f.filename)
-    f.save(save_path)
 
     try:
-        # Run recognition
-        results = recognize_faces_in_image(save_path)
+        # Run recognition (?tiled=1 / 0 forces tiling on or off, default: by image size).
+        # Re-uploads of identical bytes are answered from the upload cache.
+        results, cache_status = recognize_faces_in_upload(f.read(), save_path, **options)
 
         # If no encodings exist, handle gracefully
         if results is None:
@@ -453,7 +573,268 @@ def upload_photo(user_id):
     if not isinstance(results, list):
         results = []
 
-    return jsonify(results), 200
+    response = jsonify(results)
+    response.headers["X-Recognition-Cache"] = cache_status
+    return response, 200
+
+def _scope_options(params):
+    # ?branch=&section=&year= match against that class's partition first;
+    # fallback=0 skips the full-gallery retry for faces it doesn't know
+    options = {k: params.get(k) for k in ("branch", "section", "year") if params.get(k)}
+    if options:
+        options["fallback"] = params.get("fallback", "1") != "0"
+    return options
+
+def _recognize_batch(files, user_id, options=None):
+    # Runs every photo concurrently on the recognition workers. The queue
+    # takes the whole batch or none of it (QueueFull), so a full queue never
+    # leaves part of a batch running unreported.
+    # Returns (per-photo results, per-photo status, photos that failed or timed out).
+    paths = []
+    for f in files:
+        save_path = upload_path(secure_filename(f.filename))
+        f.save(save_path)
+        paths.append(save_path)
+    try:
+        jobs = recognition_jobs.submit_batch([(path, options or {}) for path in paths], uploads=paths,
+                                             user_id=user_id)
+    except (QueueFull, BrokenProcessPool):
+        for path in paths:
+            discard_upload(path)
+        raise
+
+    finished = recognition_jobs.wait_all([job["job_id"] for job in jobs], BATCH_TIMEOUT_SECONDS)
+    per_photo, photos, failed = [], [], []
+    for f, job in zip(files, finished):
+        status = job["status"] if job else "missing"
+        error = job.get("error") if job else None
+        if status in ("queued", "running"):
+            status, error = "timeout", f"no result after {BATCH_TIMEOUT_SECONDS}s"
+        ok = status == "done"
+        per_photo.append(job["result"] if ok else [])
+        photo = {"filename": f.filename, "job_id": job["job_id"] if job else None, "status": status,
+                 "faces": len(job["result"]) if ok else None, "error": error}
+        photos.append(photo)
+        if not ok:
+            failed.append(photo)
+    return per_photo, photos, failed
+
+@app.route('/upload-photos/<user_id>', methods=['POST'])
+def upload_photos(user_id):
+    # Several photos of one room in one request; students seen in more
+    # than one photo are counted once with their best match
+    if get_role() != "teacher":
+        return jsonify({"error": "unauthorized"}), 403
+
+    files = [f for f in request.files.getlist('images') if f.filename]
+    if not files:
+        return jsonify({"error": "no files uploaded"}), 400
+
+    try:
+        per_photo, photos, failed = _recognize_batch(files, user_id, _scope_options(request.form))
+    except (QueueFull, BrokenProcessPool) as e:
+        return jsonify({"error": str(e)}), 503
+
+    merged = merge_results(per_photo)
+    merged["photos"] = photos
+    merged["present_count"] = len(merged["students"])
+    merged["unknown_count"] = len(merged["unknown"])
+    # photos that failed or timed out are not in the roll call above
+    merged["failed_photos"] = failed
+    merged["complete"] = not failed
+    if len(failed) == len(files):
+        return jsonify(dict(merged, error="no photo could be processed")), 500
+    return jsonify(merged), 200
+
+def _parse_day(value):
+    # YYYY-MM-DD like the export filters; empty means today (the DB layer's default).
+    # Raises ValueError (or TypeError for a non-string) for anything else.
+    return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d") if value else None
+
+@app.route('/roll-call/<user_id>', methods=['POST'])
+def roll_call(user_id):
+    # One call per lecture: photos of the class in, attendance written out.
+    # Form fields: branch, section, year (optional), date (optional, YYYY-MM-DD),
+    # dry_run=1 to get the present/absent lists without saving.
+    if get_role() != "teacher":
+        return jsonify({"error": "unauthorized"}), 403
+
+    files = [f for f in request.files.getlist('images') if f.filename]
+    if not files:
+        return jsonify({"error": "no files uploaded"}), 400
+    branch = request.form.get("branch")
+    section = request.form.get("section")
+    if not branch and not section:
+        return jsonify({"error": "branch or section is required"}), 400
+    try:
+        recorded_by = int(user_id)
+    except ValueError:
+        return jsonify({"error": "user_id must be a number"}), 400
+    try:
+        day = _parse_day(request.form.get("date"))
+    except ValueError:
+        return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+
+    try:
+        # the class's own partition first; visitors still resolve via the fallback
+        per_photo, photos, failed = _recognize_batch(files, user_id, _scope_options(request.form))
+    except (QueueFull, BrokenProcessPool) as e:
+        return jsonify({"error": str(e)}), 503
+
+    # Everyone missing from a failed or timed-out photo would be marked
+    # Absent, so nothing is written unless every photo was processed
+    try:
+        summary = take_roll_call(per_photo, recorded_by=recorded_by, branch=branch, section=section,
+                                 year=request.form.get("year"), date=day,
+                                 dry_run=request.form.get("dry_run") == "1" or bool(failed))
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 500
+    summary["photos"] = photos
+    summary["failed_photos"] = failed
+    if failed:
+        return jsonify(dict(summary, error=f"Attendance not saved: {len(failed)} photo(s) failed")), 500
+    if summary["saved"] is None:
+        return jsonify(dict(summary, error="Failed to save attendance")), 500
+    return jsonify(summary), 200
+
+@app.route('/upload-video/<user_id>', methods=['POST'])
+def upload_video(user_id):
+    # Videos always run as a background job; poll /jobs/<job_id> for the
+    # per-student first/last seen summary
+    if get_role() != "teacher":
+        return jsonify({"error": "unauthorized"}), 403
+
+    if 'video' not in request.files or not request.files['video'].filename:
+        return jsonify({"error": "no file uploaded"}), 400
+
+    options = {}
+    if request.form.get("tolerance"):
+        try:
+            options["tolerance"] = float(request.form["tolerance"])
+        except ValueError:
+            return jsonify({"error": "tolerance must be a number"}), 400
+        if not 0 < options["tolerance"] <= 1:
+            return jsonify({"error": "tolerance must be between 0 and 1"}), 400
+
+    f = request.files['video']
+    save_path = upload_path(secure_filename(f.filename))
+    f.save(save_path)
+    try:
+        job = recognition_jobs.submit_call(run_video_job, (save_path, options), upload=save_path,
+                                           user_id=user_id, kind="video")
+    except (QueueFull, BrokenProcessPool) as e:
+        discard_upload(save_path)
+        return jsonify({"error": str(e)}), 503
+    job["poll"] = f"/jobs/{job['job_id']}"
+    return jsonify(job), 202
+
+@app.route('/unknown-clusters', methods=['GET'])
+def list_unknown_clusters():
+    if get_role() != "admin":
+        return jsonify({"error": "unauthorized"}), 403
+    rows = unknown_clusters.list(min_hits=request.args.get("min_hits", 1, type=int),
+                                 limit=request.args.get("limit", 100, type=int))
+    return jsonify({"clusters": rows}), 200
+
+def _remove_new_student(student_id):
+    # Undo save_student() for a student that has no attendance yet
+    conn = get_connection()
+    if not conn:
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM students WHERE student_id = %s", (student_id,))
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+    notify_change("students")
+
+@app.route('/unknown-clusters/<int:cluster_id>/enroll', methods=['POST'])
+def enroll_unknown_cluster(cluster_id):
+    # Turn a recurring unknown face into a student without re-encoding anything:
+    # the cluster's kept encodings go straight into the gallery
+    if get_role() != "admin":
+        return jsonify({"error": "unauthorized"}), 403
+
+    data = request.get_json(force=True)
+    name = data.get("name")
+    roll_no = data.get("roll_no")
+    if not name or not roll_no:
+        return jsonify({"error": "name and roll_no are required"}), 400
+
+    # The cluster is only removed once its encodings are in the store, and a
+    # student created here is removed again if they could not be written
+    cluster, members = unknown_clusters.get(cluster_id)
+    if cluster is None:
+        return jsonify({"error": "cluster not found"}), 404
+
+    conn = get_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT student_id, name FROM students WHERE roll_no = %s", (roll_no,))
+        existing = cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+    if existing:
+        # the gallery carries the student's recorded name, not the one typed in
+        student_id, name = existing
+    else:
+        student_id = save_student(name=name, roll_no=roll_no, branch=data.get("branch"),
+                                  section=data.get("section"), year=data.get("year"),
+                                  passout_year=data.get("passout_year"))
+        if not student_id:
+            return jsonify({"error": "Failed to save student"}), 500
+
+    try:
+        meta = encoding_builder.enroll_encodings(members, name, student_id, source=f"cluster-{cluster_id}")
+    except Exception as e:
+        if not existing:
+            _remove_new_student(student_id)
+        return jsonify({"error": f"Failed to write encodings: {e}"}), 500
+    unknown_clusters.pop(cluster_id)
+    reload_encodings()
+
+    return jsonify({"student_id": student_id, "name": name, "roll_no": roll_no, "cluster": cluster,
+                    "encodings_added": len(members), "version": meta["version"]}), 200
+
+@app.route('/attendance/bulk', methods=['POST'])
+def save_attendance_bulk_route():
+    # {"recorded_by": 101, "date": "YYYY-MM-DD" (optional),
+    #  "records": [{"student_id": 1, "status": "Present"}, ...]}
+    if get_role() != "teacher":
+        return jsonify({"error": "unauthorized"}), 403
+
+    data = request.get_json(force=True)
+    records = data.get("records") or []
+    try:
+        pairs = [(int(r["student_id"]), str(r.get("status", "Present")).lower() == "present") for r in records]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "each record needs a numeric student_id"}), 400
+    try:
+        day = _parse_day(data.get("date"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+
+    written = save_attendance_bulk(pairs, data.get("recorded_by"), date=day)
+    if written is None:
+        return jsonify({"error": "Failed to save attendance"}), 500
+    return jsonify({"saved": written}), 200
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    if get_role() != "teacher":
+        return jsonify({"error": "unauthorized"}), 403
+
+    # ?wait=N long-polls up to N seconds for the job to finish
+    job = recognition_jobs.get(job_id, wait=request.args.get("wait", 0, type=float))
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job), 200
 
 @app.route('/delete-student/<roll_no>', methods=['DELETE'])
 def delete_student(roll_no):
@@ -464,7 +845,7 @@ def delete_student(roll_no):
         cursor = conn.cursor()
 
         # Check if student exists
-        cursor.execute("SELECT * FROM students WHERE roll_no = %s", (roll_no,))
+        cursor.execute("SELECT student_id, section FROM students WHERE roll_no = %s", (roll_no,))
         student = cursor.fetchone()
         if not student:
             cursor.close()
@@ -473,7 +854,11 @@ def delete_student(roll_no):
 
         # Delete student
         cursor.execute("DELETE FROM students WHERE roll_no = %s", (roll_no,))
+        # their attendance rows went with them (ON DELETE CASCADE)
+        refresh_daily_summary(cursor, sections=[student[1]])
         conn.commit()
+        notify_change("students")
+        notify_change("attendance")
         cursor.close()
         conn.close()
 
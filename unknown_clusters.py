@@ -0,0 +1,201 @@
+# unknown_clusters.py
+# Online clustering of unrecognised faces.
+#
+# Every unknown encoding is compared with the running centroids: within
+# CLUSTER_RADIUS it joins that cluster (hit count, last seen, running-mean
+# centroid, and a few member encodings kept for enrolment); otherwise it
+# starts a new cluster whose crop becomes the cluster's representative. Only
+# new clusters write a crop, so a person who is seen every day costs one file.
+#
+# State lives in uploads/unknown_faces/clusters.npz. Several processes can
+# log unknown faces, so every update is load-if-changed -> modify -> save
+# under a lock file.
+#
+# The store is bounded: clusters not seen for UNKNOWN_CLUSTER_MAX_AGE_DAYS
+# are dropped, and beyond UNKNOWN_MAX_CLUSTERS the least-seen ones go
+# (fewest hits, then longest unseen). A dropped cluster's crop is deleted.
+import os
+import json
+import time
+import threading
+import numpy as np
+import encodings_store
+
+CLUSTER_FILE = os.path.join("uploads", "unknown_faces", "clusters.npz")
+CLUSTER_RADIUS = float(os.getenv("UNKNOWN_CLUSTER_RADIUS", "0.5"))
+MEMBERS_PER_CLUSTER = int(os.getenv("UNKNOWN_CLUSTER_MEMBERS", "5"))
+MAX_CLUSTERS = int(os.getenv("UNKNOWN_MAX_CLUSTERS", "5000"))
+MAX_AGE_DAYS = float(os.getenv("UNKNOWN_CLUSTER_MAX_AGE_DAYS", "90"))  # 0 = keep until evicted by the cap
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class ClusterStore:
+    def __init__(self, path=CLUSTER_FILE, radius=CLUSTER_RADIUS, max_members=MEMBERS_PER_CLUSTER,
+                 max_clusters=MAX_CLUSTERS, max_age_days=MAX_AGE_DAYS, crop_dir=None):
+        self.path = path
+        self.radius = radius
+        self.max_members = max_members
+        self.max_clusters = max_clusters
+        self.max_age_days = max_age_days
+        self.crop_dir = crop_dir or os.path.dirname(path)  # where the writer puts representative crops
+        self._lock = threading.Lock()
+        self._signature = None
+        self._reset()
+
+    def _reset(self):
+        dim = encodings_store.ENCODING_DIM
+        self.centroids = np.zeros((0, dim), dtype=np.float32)
+        self.members = np.zeros((0, dim), dtype=np.float32)
+        self.member_cluster = np.zeros(0, dtype=np.int64)
+        self.clusters = []  # dicts, parallel to centroids
+        self.next_id = 1
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def _load_if_changed(self):
+        sig = self._file_signature()
+        if sig == self._signature:
+            return
+        self._reset()
+        if sig is not None:
+            try:
+                with np.load(self.path, allow_pickle=False) as data:
+                    meta = json.loads(str(data["meta"]))
+                    self.centroids = data["centroids"].astype(np.float32)
+                    self.members = data["members"].astype(np.float32)
+                    self.member_cluster = data["member_cluster"].astype(np.int64)
+                self.clusters = meta["clusters"]
+                self.next_id = meta["next_id"]
+            except (OSError, KeyError, ValueError) as e:
+                print(f"❌ Unknown-face clusters unreadable, starting over: {e}")
+                self._reset()
+        self._signature = sig
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp{os.getpid()}.npz"
+        meta = json.dumps({"clusters": self.clusters, "next_id": self.next_id})
+        np.savez(tmp, centroids=self.centroids, members=self.members,
+                 member_cluster=self.member_cluster, meta=np.array(meta))
+        os.replace(tmp, self.path)
+        self._signature = self._file_signature()
+
+    def add_many(self, items, now=None):
+        """Cluster a batch of (encoding, crop_filename) pairs.
+
+        Returns one (cluster_id, is_new) per item. A new cluster takes the
+        item's crop_filename as its representative; the caller writes that
+        crop only when is_new is True.
+        """
+        now = now or time.strftime(TIME_FORMAT)
+        out = []
+        with self._lock, encodings_store.FileLock(self.path):
+            self._load_if_changed()
+            for enc, crop in items:
+                enc = np.asarray(enc, dtype=np.float32).reshape(-1)
+                idx = None
+                if len(self.clusters):
+                    dist = np.linalg.norm(self.centroids - enc, axis=1)
+                    best = int(np.argmin(dist))
+                    if dist[best] <= self.radius:
+                        idx = best
+                if idx is None:
+                    cluster = {"cluster_id": self.next_id, "hits": 1, "crop": crop,
+                               "first_seen": now, "last_seen": now}
+                    self.next_id += 1
+                    self.clusters.append(cluster)
+                    self.centroids = np.vstack([self.centroids, enc[None, :]])
+                    self._add_member(len(self.clusters) - 1, enc)
+                    out.append((cluster["cluster_id"], True))
+                    continue
+                cluster = self.clusters[idx]
+                cluster["hits"] += 1
+                cluster["last_seen"] = now
+                self.centroids[idx] += (enc - self.centroids[idx]) / cluster["hits"]
+                self._add_member(idx, enc)
+                out.append((cluster["cluster_id"], False))
+            # clusters created just now keep their slot: their crops are about to be written
+            evicted = self._evict({cid for cid, is_new in out if is_new})
+            self._save()
+        for crop in evicted:
+            try:
+                os.remove(os.path.join(self.crop_dir, crop))
+            except OSError:
+                pass  # never written (is_new was ignored) or already gone
+        return out
+
+    def _evict(self, protected):
+        """Drop expired clusters, then the least-seen ones over max_clusters.
+        Returns the representative crops of the dropped clusters."""
+        drop = set()
+        if self.max_age_days:
+            cutoff = time.strftime(TIME_FORMAT, time.localtime(time.time() - self.max_age_days * 86400))
+            drop = {i for i, c in enumerate(self.clusters)
+                    if c["last_seen"] < cutoff and c["cluster_id"] not in protected}
+        over = len(self.clusters) - len(drop) - self.max_clusters
+        if over > 0:
+            candidates = sorted((i for i, c in enumerate(self.clusters)
+                                 if i not in drop and c["cluster_id"] not in protected),
+                                key=lambda i: (self.clusters[i]["hits"], self.clusters[i]["last_seen"]))
+            drop.update(candidates[:over])
+        if not drop:
+            return []
+        keep = np.array([i not in drop for i in range(len(self.clusters))], dtype=bool)
+        dropped = [c for i, c in enumerate(self.clusters) if i in drop]
+        keep_members = ~np.isin(self.member_cluster, [c["cluster_id"] for c in dropped])
+        self.centroids = self.centroids[keep]
+        self.members = self.members[keep_members]
+        self.member_cluster = self.member_cluster[keep_members]
+        self.clusters = [c for i, c in enumerate(self.clusters) if i not in drop]
+        return [c["crop"] for c in dropped if c.get("crop")]
+
+    def _add_member(self, idx, enc):
+        cid = self.clusters[idx]["cluster_id"]
+        if int(np.count_nonzero(self.member_cluster == cid)) >= self.max_members:
+            return
+        self.members = np.vstack([self.members, enc[None, :]])
+        self.member_cluster = np.append(self.member_cluster, cid)
+
+    def list(self, min_hits=1, limit=100):
+        with self._lock:
+            self._load_if_changed()
+            counts = np.bincount(self.member_cluster, minlength=self.next_id) if self.member_cluster.size else None
+            rows = [dict(c, members=int(counts[c["cluster_id"]]) if counts is not None else 0)
+                    for c in self.clusters if c["hits"] >= min_hits]
+        rows.sort(key=lambda c: -c["hits"])
+        return rows[:limit]
+
+    def get(self, cluster_id):
+        """(cluster dict, member encodings) without removing it, or (None, None)."""
+        with self._lock:
+            self._load_if_changed()
+            for cluster in self.clusters:
+                if cluster["cluster_id"] == cluster_id:
+                    return dict(cluster), self.members[self.member_cluster == cluster_id].copy()
+        return None, None
+
+    def pop(self, cluster_id):
+        """Remove a cluster and return (cluster dict, member encodings), or (None, None)."""
+        with self._lock, encodings_store.FileLock(self.path):
+            self._load_if_changed()
+            for idx, cluster in enumerate(self.clusters):
+                if cluster["cluster_id"] == cluster_id:
+                    break
+            else:
+                return None, None
+            keep = self.member_cluster != cluster_id
+            members = self.members[~keep].copy()
+            self.members = self.members[keep]
+            self.member_cluster = self.member_cluster[keep]
+            self.centroids = np.delete(self.centroids, idx, axis=0)
+            del self.clusters[idx]
+            self._save()
+        return cluster, members
+
+
+clusters = ClusterStore()
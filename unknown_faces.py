@@ -0,0 +1,179 @@
+# unknown_faces.py
+# Background writer for unrecognised faces.
+#
+# The request path only hands a crop to a bounded queue. A single writer
+# thread drains it in batches: crops are written to UNKNOWN_FACES_DIR and the
+# matching `logs` rows go in with one executemany + commit per batch. When the
+# writer falls behind, new faces are dropped (and counted) instead of
+# stalling recognition.
+#
+# Faces that come with their encoding are clustered first (see
+# unknown_clusters.py); a crop is only written for a face that starts a new
+# cluster, repeat sightings just bump that cluster's hit count.
+import os
+import uuid
+import queue
+import atexit
+import datetime
+import threading
+import time
+import numpy as np
+import cv2
+from db import get_connection
+from unknown_clusters import clusters
+from metrics import span
+
+UNKNOWN_FACES_DIR = "uploads/unknown_faces"
+QUEUE_SIZE = int(os.getenv("UNKNOWN_QUEUE_SIZE", "256"))
+BATCH_SIZE = int(os.getenv("UNKNOWN_BATCH_SIZE", "50"))
+FLUSH_SECONDS = float(os.getenv("UNKNOWN_FLUSH_SECONDS", "1.0"))
+ENQUEUE_TIMEOUT = 0.05  # brief backpressure before a face is dropped, once per flush interval
+
+_STOP = object()
+
+
+def unknown_filename():
+    # second-resolution timestamp for humans, random suffix so names never collide
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    return f"unknown_{timestamp}_{uuid.uuid4().hex[:8]}.jpg"
+
+
+class UnknownFaceWriter:
+    def __init__(self, folder=UNKNOWN_FACES_DIR, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 flush_seconds=FLUSH_SECONDS):
+        self.folder = folder
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._last_drop = None  # time.monotonic() of the last dropped face
+        self.stats = {"queued": 0, "written": 0, "clustered": 0, "logged": 0, "dropped": 0, "batches": 0,
+                      "errors": 0}
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                os.makedirs(self.folder, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="unknown-face-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, face_rgb, message="Face not recognized", encoding=None):
+        """Queue one crop (RGB array) and optionally its encoding.
+
+        Returns the file name the crop will get if it is written, or None if
+        the face was dropped.
+        """
+        self._ensure_started()
+        filename = unknown_filename()
+        # copy so the queued crop doesn't pin the whole decoded photo in memory
+        if encoding is not None:
+            encoding = np.asarray(encoding, dtype=np.float32)
+        item = (filename, np.ascontiguousarray(face_rgb).copy(), message, encoding)
+        # Once a face has been dropped the writer is known to be behind, so
+        # until the next flush interval the rest are dropped without waiting:
+        # a photo full of unknown faces costs one ENQUEUE_TIMEOUT, not one per face
+        last_drop = self._last_drop
+        recently_full = last_drop is not None and time.monotonic() - last_drop < self.flush_seconds
+        try:
+            if recently_full:
+                self._queue.put_nowait(item)
+            else:
+                self._queue.put(item, timeout=ENQUEUE_TIMEOUT)
+        except queue.Full:
+            self._last_drop = time.monotonic()
+            self.stats["dropped"] += 1
+            return None
+        self.stats["queued"] += 1
+        return filename
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_seconds
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write_batch(batch)
+            if stop:
+                return
+
+    def _cluster(self, batch):
+        # cluster id and "write the crop?" per item; unencoded faces always get a crop
+        with_enc = [i for i, item in enumerate(batch) if item[3] is not None]
+        out = [(None, True)] * len(batch)
+        if with_enc:
+            try:
+                with span("unknown_cluster"):
+                    assigned = clusters.add_many([(batch[i][3], batch[i][0]) for i in with_enc])
+                for i, a in zip(with_enc, assigned):
+                    out[i] = a
+                self.stats["clustered"] += len(with_enc)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"❌ Unknown face clustering failed: {e}")
+        return out
+
+    def _write_batch(self, batch):
+        rows = []
+        for (filename, crop, message, _), (cluster_id, is_new) in zip(batch, self._cluster(batch)):
+            try:
+                if not is_new:
+                    rows.append(("UnknownFace", f"cluster {cluster_id}: {message}"))
+                    continue
+                if crop.size and cv2.imwrite(os.path.join(self.folder, filename),
+                                             cv2.cvtColor(crop, cv2.COLOR_RGB2BGR)):
+                    self.stats["written"] += 1
+                label = f"{filename} (cluster {cluster_id})" if cluster_id is not None else filename
+                rows.append(("UnknownFace", f"{label}: {message}"))
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"❌ Unknown face crop not saved: {e}")
+        if not rows:
+            return
+        conn = get_connection()
+        if conn is None:
+            self.stats["errors"] += 1
+            return
+        try:
+            with span("db.unknown_log_batch"):
+                cursor = conn.cursor()
+                cursor.executemany("INSERT INTO logs (log_type, message) VALUES (%s, %s)", rows)
+                conn.commit()
+            cursor.close()
+            self.stats["logged"] += len(rows)
+            self.stats["batches"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"❌ Unknown face log batch failed: {e}")
+        finally:
+            conn.close()
+
+    def close(self, timeout=5.0):
+        # flush whatever is queued on shutdown
+        if self._thread is not None and self._thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                return
+            self._thread.join(timeout)
+
+
+writer = UnknownFaceWriter()
+atexit.register(writer.close)
@@ -0,0 +1,191 @@
+# video.py
+# Attendance from a video file or frame stream (e.g. a webcam recording of
+# the class entrance).
+#
+# Frames are sampled adaptively: slowly while nobody is in view, faster while
+# faces are being tracked. Detections are linked across sampled frames by box
+# overlap, and each track is only encoded and matched a few times (until it
+# has a confident match) instead of on every frame.
+import os
+import cv2
+import face_recognition
+import detection
+from recognition import get_gallery, assign_matches, student_key, MATCH_CANDIDATES
+
+IDLE_FPS = float(os.getenv("VIDEO_IDLE_FPS", "2"))      # samples/sec with no faces in view
+ACTIVE_FPS = float(os.getenv("VIDEO_ACTIVE_FPS", "6"))  # samples/sec while tracking
+TRACK_IOU = 0.3
+TRACK_MAX_GAP = 1.5           # seconds a track may go unseen before it is closed
+MAX_ENCODES_PER_TRACK = 3
+CONFIDENT_MARGIN = 0.85       # distance <= tolerance * margin stops re-encoding a track
+
+
+class Track:
+    __slots__ = ("track_id", "box", "first_seen", "last_seen", "encodes", "name", "student_id", "distance")
+
+    def __init__(self, track_id, box, t):
+        self.track_id = track_id
+        self.box = box
+        self.first_seen = t
+        self.last_seen = t
+        self.encodes = 0
+        self.name = None
+        self.student_id = None
+        self.distance = None
+
+    def needs_encoding(self, tolerance):
+        if self.encodes >= MAX_ENCODES_PER_TRACK:
+            return False
+        return self.distance is None or self.distance > tolerance * CONFIDENT_MARGIN
+
+
+def _associate(tracks, boxes):
+    # Greedy IoU matching of live tracks to this frame's detections
+    pairs = sorted(((detection.box_iou(t.box, b), ti, bi) for ti, t in enumerate(tracks)
+                    for bi, b in enumerate(boxes)), reverse=True)
+    used_t, used_b, links = set(), set(), []
+    for iou, ti, bi in pairs:
+        if iou < TRACK_IOU:
+            break
+        if ti in used_t or bi in used_b:
+            continue
+        used_t.add(ti)
+        used_b.add(bi)
+        links.append((ti, bi))
+    return links, [bi for bi in range(len(boxes)) if bi not in used_b]
+
+
+def track_frames(frames, tolerance=0.45, model="hog", on_activity=None):
+    """Core tracker. `frames` yields (seconds, rgb_image) for the frames to look at.
+
+    `on_activity(bool)` is told after every frame whether anyone is being
+    tracked, so the frame source can adapt its sampling rate. Returns the
+    tracks plus counters; see summarise() for the per-student view.
+    """
+    gallery = get_gallery()  # pinned for the whole video
+    live, closed = [], []
+    next_id = 0
+    stats = {"frames_sampled": 0, "faces_detected": 0, "faces_encoded": 0, "gallery_version": gallery.version}
+
+    for t, rgb in frames:
+        stats["frames_sampled"] += 1
+        boxes = detection.detect_faces(rgb, model=model)
+        stats["faces_detected"] += len(boxes)
+
+        # close tracks that have been out of view too long
+        still = []
+        for tr in live:
+            (still if t - tr.last_seen <= TRACK_MAX_GAP else closed).append(tr)
+        live = still
+
+        links, fresh = _associate(live, boxes)
+        for ti, bi in links:
+            live[ti].box = boxes[bi]
+            live[ti].last_seen = t
+        for bi in fresh:
+            live.append(Track(next_id, boxes[bi], t))
+            next_id += 1
+
+        # encode only tracks seen in this frame that still lack a confident match
+        todo = [tr for tr in live if tr.last_seen == t and tr.needs_encoding(tolerance)]
+        if todo and gallery.size:
+            encodings = face_recognition.face_encodings(rgb, [tr.box for tr in todo])
+            stats["faces_encoded"] += len(encodings)
+            cand_dist, cand_idx = gallery.index.search(encodings, MATCH_CANDIDATES)
+            assigned = assign_matches(cand_dist, cand_idx, gallery.keys, tolerance)
+            for i, tr in enumerate(todo):
+                tr.encodes += 1
+                match = assigned[i]
+                if match is not None and (tr.distance is None or match[1] < tr.distance):
+                    row, dist = match
+                    tr.name, tr.student_id, tr.distance = gallery.names[row], gallery.ids[row], dist
+                elif tr.name is None:
+                    tr.distance = float(cand_dist[i, 0])
+
+        if on_activity is not None:
+            on_activity(bool(live))
+
+    closed.extend(live)
+    return closed, stats
+
+
+def summarise(tracks, tolerance=0.45):
+    students = {}
+    unknown = 0
+    for tr in tracks:
+        if tr.name is None or tr.distance is None or tr.distance > tolerance:
+            unknown += 1
+            continue
+        s = students.setdefault(student_key(tr.student_id, tr.name),
+                                {"name": tr.name, "student_id": tr.student_id,
+                                 "first_seen": tr.first_seen, "last_seen": tr.last_seen,
+                                 "distance": tr.distance, "tracks": 0})
+        s["first_seen"] = min(s["first_seen"], tr.first_seen)
+        s["last_seen"] = max(s["last_seen"], tr.last_seen)
+        s["distance"] = min(s["distance"], tr.distance)
+        s["tracks"] += 1
+    for s in students.values():
+        s["first_seen"] = round(s["first_seen"], 2)
+        s["last_seen"] = round(s["last_seen"], 2)
+    return {"students": sorted(students.values(), key=lambda s: s["first_seen"]), "unknown_tracks": unknown}
+
+
+class _AdaptiveSampler:
+    """Iterates a cv2.VideoCapture, decoding only the frames the tracker wants.
+
+    Skipped frames are grab()bed (demuxed, not decoded). The tracker reports
+    back through set_active() whether it is following anyone, which switches
+    between the idle and active sampling rates.
+    """
+
+    def __init__(self, capture, fps):
+        self.capture = capture
+        self.fps = fps
+        self.active = False
+        self.frames_read = 0
+
+    def __iter__(self):
+        idle_step = max(1, int(round(self.fps / IDLE_FPS)))
+        active_step = max(1, int(round(self.fps / ACTIVE_FPS)))
+        frame_idx = -1
+        next_idx = 0
+        while True:
+            if not self.capture.grab():
+                return
+            frame_idx += 1
+            self.frames_read += 1
+            if frame_idx < next_idx:
+                continue
+            ok, bgr = self.capture.retrieve()
+            if not ok:
+                return
+            yield frame_idx / self.fps, cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+            next_idx = frame_idx + (active_step if self.active else idle_step)
+
+    def set_active(self, active):
+        self.active = active
+
+
+def process_video(source, tolerance=0.45, model="hog"):
+    """Per-student first/last seen (seconds into the video) and best distance.
+
+    `source` is a video file path, or a camera index / stream URL understood
+    by cv2.VideoCapture.
+    """
+    if isinstance(source, str) and source.isdigit():
+        source = int(source)
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f"could not open video source {source!r}")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        sampler = _AdaptiveSampler(capture, fps)
+        tracks, stats = track_frames(sampler, tolerance=tolerance, model=model, on_activity=sampler.set_active)
+    finally:
+        capture.release()
+
+    summary = summarise(tracks, tolerance)
+    summary.update(stats)
+    summary["frames_read"] = sampler.frames_read
+    summary["duration"] = round(sampler.frames_read / fps, 2)
+    return summary